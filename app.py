@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*- 
 #!/usr/bin/env python
+import hashlib
 import logging as logger
+import time
 import click
 
 from emulator import Emulator
@@ -9,13 +11,32 @@ from emulator import Emulator
 @click.command()
 @click.option('--filename', type=str, required=True, help='GameBoy ROM file')
 @click.option('--debug', type=bool, required=False, is_flag=True, help='print debug log information')
-def main(filename: str, debug: bool) -> None:
+@click.option('--no-blockcache', type=bool, required=False, is_flag=True, help='interpret instructions one at a time')
+@click.option('--headless', type=bool, required=False, is_flag=True, help='run without window and sound output, as fast as possible')
+@click.option('--frames', type=int, required=False, default=0, help='with --headless, frames to run before reporting the speed and exiting')
+@click.option('--frame-skip', type=int, required=False, default=0, help='frames skipped after each drawn frame')
+@click.option('--adaptive', type=bool, required=False, is_flag=True, help='only skip frames while running behind, up to --frame-skip in a row')
+def main(filename: str, debug: bool, no_blockcache: bool, headless: bool, frames: int, frame_skip: int, adaptive: bool) -> None:
+	if headless != (frames > 0):
+		# Without a window nothing stops the emulation, and a window isn't updated by run_frames
+		raise click.UsageError("--headless and --frames have to be given together")
 	if debug:
 		logger.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logger.DEBUG)
 	else:
 		logger.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logger.INFO)
 	# Application
-	emu = Emulator(filename)
+	emu = Emulator(filename, blockcache=not no_blockcache, headless=headless)
+	emu.set_frame_skip(frame_skip, adaptive)
+	if headless:
+		start = time.perf_counter()
+		_, frames_done = emu.run_frames(frames)
+		elapsed = time.perf_counter() - start
+		logger.info(f"{frames_done} frames in {elapsed:.2f}s, {frames_done / elapsed:.1f} FPS")
+		logger.info(f"Screen MD5: {hashlib.md5(emu.get_framebuffer()).hexdigest()}")
+		serial = emu.mobo.getserial()
+		if serial:
+			logger.info(f"Serial output:\n{serial}")
+		return
 	emu.run()
 
 if __name__ == "__main__":
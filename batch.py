@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import logging as logger
+import json
+import os
+import time
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+import click
+
+import gbcore as gb
+from gbcore.mobo import UNLIMITED
+from gbcore.parameters import ROWS, COLS, INTR_HIGHTOLOW
+
+FRAMEBUFFER_SIZE = ROWS * COLS * 4
+SERIAL_SIZE = 1024
+
+class Job:
+	"""One emulator run: a ROM, the joypad inputs and the number of frames to run.
+
+	`inputs` is a list of (frame, button, pressed) tuples, applied before the given frame. `memory` is the (address,
+	length) range which is read back when the run is done.
+	"""
+	def __init__(self, rom: str, frames: int, inputs=(), memory=(0xC000, 0x2000)):
+		self.rom = rom
+		self.frames = frames
+		self.inputs = sorted(inputs, key=lambda i: i[0])
+		self.memory = tuple(memory)
+
+class JobResult:
+	def __init__(self, framebuffer, memory, serial: str, cycles: int, frames: int):
+		self.framebuffer = framebuffer # (144, 160, 4) RGBA view into the shared memory
+		self.memory = memory # View into the shared memory
+		self.serial = serial
+		self.cycles = cycles
+		self.frames = frames
+
+class BatchResults:
+	"""Results of `BatchRunner.run`. The frame buffers and memory snapshots stay in shared memory until `close`, and
+	the views of them have to be released before that.
+	"""
+	def __init__(self, shm, slot_size, memory_size, metadata):
+		self.shm = shm
+		self.slot_size = slot_size
+		self.memory_size = memory_size
+		self.metadata = metadata
+
+	def __len__(self):
+		return len(self.metadata)
+
+	def __getitem__(self, i):
+		serial_length, memory_length, cycles, frames = self.metadata[i]
+		slot = self.shm.buf[i * self.slot_size:(i + 1) * self.slot_size]
+		framebuffer = slot[:FRAMEBUFFER_SIZE].cast("B", shape=(ROWS, COLS, 4))
+		serial = bytes(slot[FRAMEBUFFER_SIZE:FRAMEBUFFER_SIZE + serial_length]).decode("latin-1")
+		memory = slot[FRAMEBUFFER_SIZE + SERIAL_SIZE:FRAMEBUFFER_SIZE + SERIAL_SIZE + memory_length]
+		return JobResult(framebuffer, memory, serial, cycles, frames)
+
+	def close(self):
+		self.shm.close()
+		self.shm.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+# Per worker process: the machines right after loading each ROM, and the shared memory of the current batch
+_templates = {}
+_shm = None
+
+def _attach(name):
+	global _shm
+	if _shm is None or _shm.name != name:
+		if _shm is not None:
+			_shm.close()
+		_shm = shared_memory.SharedMemory(name=name)
+	return _shm
+
+def _run_job(task):
+	shm_name, index, slot_size, job = task
+	template = _templates.get(job.rom)
+	if template is None:
+		template = gb.Mobo(headless=True)
+		template.load(job.rom)
+		_templates[job.rom] = template
+	# A warm worker only has to copy the machine instead of parsing the ROM again
+	mb = template.clone()
+	cycles = frames = 0
+	for frame, button, pressed in job.inputs + [(job.frames, None, None)]:
+		if frame > frames:
+			c, f = mb.run(UNLIMITED, frame - frames)
+			cycles += c
+			frames += f
+		if button is not None and mb.joypad.key_event(button, pressed):
+			mb.cpu.set_interruptflag(INTR_HIGHTOLOW)
+	# Write the results straight into this job's slot of the shared memory
+	slot = _attach(shm_name).buf[index * slot_size:(index + 1) * slot_size]
+	slot[:FRAMEBUFFER_SIZE] = mb.get_framebuffer().cast("B")
+	serial = mb.getserial().encode("latin-1")[:SERIAL_SIZE]
+	slot[FRAMEBUFFER_SIZE:FRAMEBUFFER_SIZE + len(serial)] = serial
+	address, length = job.memory
+	memory = bytes([mb.getitem((address + n) & 0xFFFF) for n in range(length)])
+	slot[FRAMEBUFFER_SIZE + SERIAL_SIZE:FRAMEBUFFER_SIZE + SERIAL_SIZE + length] = memory
+	slot.release()
+	return index, (len(serial), length, cycles, frames)
+
+# 批量运行
+class BatchRunner:
+	"""Runs jobs on a pool of worker processes, which are kept warm between jobs and batches."""
+	def __init__(self, processes: int = None):
+		# The workers have to share the resource tracker of this process. Otherwise each would start its own, which
+		# unlinks the shared memory it has seen when the worker exits.
+		resource_tracker.ensure_running()
+		self.pool = Pool(processes)
+
+	def run(self, jobs):
+		memory_size = max([job.memory[1] for job in jobs] + [0])
+		slot_size = FRAMEBUFFER_SIZE + SERIAL_SIZE + memory_size
+		shm = shared_memory.SharedMemory(create=True, size=max(1, len(jobs) * slot_size))
+		metadata = [None] * len(jobs)
+		tasks = [(shm.name, i, slot_size, job) for i, job in enumerate(jobs)]
+		for index, meta in self.pool.imap_unordered(_run_job, tasks):
+			metadata[index] = meta
+		return BatchResults(shm, slot_size, memory_size, metadata)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def run_batch(jobs, processes: int = None):
+	with BatchRunner(processes) as runner:
+		return runner.run(jobs)
+
+# parse command line
+@click.command()
+@click.option('--jobs', type=str, required=True, help='JSON file with a list of {"rom", "frames", "inputs", "memory"}')
+@click.option('--processes', type=int, required=False, default=None, help='number of worker processes')
+@click.option('--output', type=str, required=False, default=None, help='directory for frame buffers and memory dumps')
+def main(jobs: str, processes: int, output: str) -> None:
+	logger.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logger.WARNING)
+	with open(jobs) as f:
+		jobs = [Job(**job) for job in json.load(f)]
+	start = time.perf_counter()
+	with run_batch(jobs, processes) as results:
+		elapsed = time.perf_counter() - start
+		for i, job in enumerate(jobs):
+			result = results[i]
+			print(f"{i}: {job.rom} frames={result.frames} cycles={result.cycles} serial={result.serial!r}")
+			if output is not None:
+				os.makedirs(output, exist_ok=True)
+				with open(os.path.join(output, f"{i}.rgba"), "wb") as f:
+					f.write(result.framebuffer.cast("B"))
+				with open(os.path.join(output, f"{i}.mem"), "wb") as f:
+					f.write(result.memory)
+			result.framebuffer.release()
+			result.memory.release()
+		frames = sum(meta[3] for meta in results.metadata)
+		print(f"{len(jobs)} jobs, {frames} frames in {elapsed:.2f}s ({frames / elapsed:.1f} fps)")
+
+if __name__ == "__main__":
+	main()
@@ -4,13 +4,97 @@ import logging as log
 import time
 
 import gbcore as gb
+from gbcore.mobo import UNLIMITED
+from gbcore.rewind import RewindBuffer
 
 class Emulator:
-	def __init__(self, filename: str):
-		self.mobo = gb.Mobo()
+	def __init__(self, filename: str, blockcache: bool = True, headless: bool = False):
+		self.mobo = gb.Mobo(blockcache, headless)
 		self.mobo.load(filename)
 		pass
 
+	# The run_* methods drive the emulation from code, without polling events or presenting frames. They return the
+	# number of cycles and frames which actually ran.
+	def run_frames(self, frames: int):
+		return self.mobo.run(UNLIMITED, frames)
+
+	def run_cycles(self, cycles: int):
+		return self.mobo.run(cycles, UNLIMITED)
+
+	def run_until(self, predicate, max_cycles: int = UNLIMITED):
+		# `predicate` is called with the Mobo, e.g. `lambda mb: mb.getitem(0xC000) == 0x01`
+		return self.mobo.run(max_cycles, UNLIMITED, predicate)
+
+	def save_state(self, f, screen: bool = True):
+		self.mobo.save_state(f, screen)
+
+	def load_state(self, f):
+		self.mobo.load_state(f)
+
+	def fork(self):
+		# Independent copy of this emulator with the same render settings, see Mobo.clone
+		emulator = Emulator.__new__(Emulator)
+		emulator.mobo = self.mobo.clone()
+		return emulator
+
+	def enable_rewind(self, keyframe_interval: int = 60, buffer_size: int = 8 * 1024 * 1024):
+		# Captures every frame from now on, so `rewind` can step back
+		self.mobo.rewind_buffer = RewindBuffer(self.mobo, keyframe_interval, buffer_size)
+
+	def rewind(self, frames: int = 1):
+		if self.mobo.rewind_buffer is None:
+			return 0
+		return self.mobo.rewind_buffer.rewind(frames)
+
+	def get_framebuffer(self):
+		return self.mobo.get_framebuffer()
+
+	def get_screen(self):
+		# Zero-copy (144, 160, 4) view of the screen, see PPU.get_screen
+		return self.mobo.ppu.get_screen()
+
+	def update_screen(self):
+		# Brings views returned by get_screen up to date in index mode, see PPU.update_screen
+		self.mobo.ppu.update_screen()
+
+	def set_double_buffer(self, enabled: bool = True):
+		self.mobo.ppu.set_double_buffer(enabled)
+
+	def set_frame_skip(self, frames: int, adaptive: bool = False):
+		# See Mobo.set_frame_skip. Skipped frames leave the screen as it was, and are reported by is_repeat_frame.
+		self.mobo.set_frame_skip(frames, adaptive)
+
+	def set_deferred_rendering(self, enabled: bool = True):
+		# Draws whole frames at VBlank instead of each line at its HBlank, see PPU.set_deferred
+		self.mobo.ppu.set_deferred(enabled)
+
+	def set_vectorized(self, enabled: bool = True):
+		self.mobo.ppu.set_vectorized(enabled)
+
+	def set_index_mode(self, enabled: bool = True):
+		self.mobo.ppu.set_index_mode(enabled)
+
+	def is_repeat_frame(self):
+		# True when the last frame left the screen as it was, so it doesn't have to be processed again
+		return self.mobo.ppu.frame_repeat
+
+	def get_screen_indices(self):
+		# (144, 160) shade indices, see PPU.set_index_mode
+		return self.mobo.ppu.get_screen_indices()
+
+	def set_observation(self, size=(84, 84), crop=(0, 144, 0, 160), grayscale: bool = True, stack: int = 1,
+			interval: int = 1):
+		# Downsampled observations for agents, updated at the end of each frame. Needs NumPy.
+		from gbcore.observation import Observation
+		self.mobo.ppu.set_observation(Observation(size, crop, grayscale, stack, interval))
+
+	def get_observation(self):
+		# The (stack, height, width) observations, oldest first
+		return self.mobo.ppu.observation.frames
+
+	def get_audiobuffer(self):
+		return self.mobo.get_audiobuffer()
+
 	def run(self):
 		_done = False
 		while not _done:
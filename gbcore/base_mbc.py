@@ -2,10 +2,17 @@
 #!/usr/bin/env python
 import logging as logger
 import array
+import struct
+import copy
 import os
 
 from .rtc import RTC
 
+ROMBANK_SIZE = 16 * 1024
+RAMBANK_SIZE = 8 * 1024
+# memorymodel, rambank_enabled, rambank_selected, rombank_selected, rombank0_selected
+MBC_STATE = struct.Struct("<B?B2H")
+
 class BaseMBC:
 	def __init__(self, filename, rombanks, external_ram_count, carttype, sram, battery, rtc_enabled):
 		self.filename = filename + ".ram"
@@ -26,6 +33,17 @@ class BaseMBC:
 		self.rambank_enabled = False
 		self.rambank_selected = 0
 		self.rombank_selected = 1
+		self.rombank0_selected = 0
+		# Flat views of the ROM and RAM banks currently mapped in
+		self.rom = rombanks.cast("B")
+		self.ram = self.rambanks.cast("B")
+		self.rom_window0 = None
+		self.rom_window1 = None
+		self.ram_window = None
+		self.selected_banks = None
+		# Called whenever the mapped banks change
+		self.bankswitch_callback = None
+		self.update_banks()
 		self.cgb = bool(self.getitem(0x0143) >> 7)
 	
 	def stop(self):
@@ -36,7 +54,20 @@ class BaseMBC:
 		self.rambank_initialized = True
 		# In real life the values in RAM are scrambled on initialization.
 		# Allocating the maximum, as it is easier in Cython. And it's just 128KB...
-		self.rambanks = memoryview(array.array("B", [0] * (8*1024*16))).cast("B", shape=(16, 8 * 1024))
+		self.rambanks = memoryview(array.array("B", bytes(8*1024*16))).cast("B", shape=(16, 8 * 1024))
+
+	def clone(self):
+		# Copy sharing the ROM banks with this cartridge
+		mbc = copy.copy(self)
+		mbc.init_rambanks(self.external_ram_count)
+		mbc.ram = mbc.rambanks.cast("B")
+		mbc.ram[:] = self.ram
+		if self.rtc is not None:
+			mbc.rtc = copy.copy(self.rtc)
+		mbc.bankswitch_callback = None
+		mbc.selected_banks = None
+		mbc.update_banks()
+		return mbc
 
 	def getgamename(self, rombanks):
 		return "".join([chr(rombanks[0, x]) for x in range(0x0134, 0x0142)]).split("\0")[0]
@@ -51,11 +82,44 @@ class BaseMBC:
 		else:
 			logger.error("Invalid override address: %0.4x", address)
 
+	def save_state(self, f):
+		f.write(MBC_STATE.pack(self.memorymodel, self.rambank_enabled, self.rambank_selected, self.rombank_selected,
+			self.rombank0_selected))
+		f.write(self.ram[:min(self.external_ram_count, len(self.rambanks)) * RAMBANK_SIZE])
+		if self.rtc_enabled:
+			self.rtc.save_state(f)
+
+	def load_state(self, f, state_version):
+		(self.memorymodel, self.rambank_enabled, self.rambank_selected, self.rombank_selected,
+			self.rombank0_selected) = MBC_STATE.unpack(f.read(MBC_STATE.size))
+		f.readinto(self.ram[:min(self.external_ram_count, len(self.rambanks)) * RAMBANK_SIZE])
+		if self.rtc_enabled:
+			self.rtc.load_state(f, state_version)
+		self.selected_banks = None # Resolve the windows again
+		self.update_banks()
+
+	def getrombanks(self):
+		# ROM banks mapped into 0x0000-0x3FFF and 0x4000-0x7FFF
+		return self.rombank0_selected, self.rombank_selected
+
+	def update_banks(self):
+		# Resolve the selected banks into flat windows once per bank switch, so reads only cost one index
+		banks = (self.rombank0_selected, self.rombank_selected, self.rambank_selected)
+		if banks == self.selected_banks:
+			return
+		self.selected_banks = banks
+		self.rom_window0 = self.rom[self.rombank0_selected * ROMBANK_SIZE:(self.rombank0_selected + 1) * ROMBANK_SIZE]
+		self.rom_window1 = self.rom[self.rombank_selected * ROMBANK_SIZE:(self.rombank_selected + 1) * ROMBANK_SIZE]
+		if self.rambank_selected < len(self.rambanks): # The RTC registers are selected as RAM banks 0x08-0x0C on MBC3
+			self.ram_window = self.ram[self.rambank_selected * RAMBANK_SIZE:(self.rambank_selected + 1) * RAMBANK_SIZE]
+		if self.bankswitch_callback is not None:
+			self.bankswitch_callback()
+
 	def getitem(self, address):
 		if 0x0000 <= address < 0x4000:
-			return self.rombanks[0, address]
+			return self.rom_window0[address]
 		elif 0x4000 <= address < 0x8000:
-			return self.rombanks[self.rombank_selected, address - 0x4000]
+			return self.rom_window1[address - 0x4000]
 		elif 0xA000 <= address < 0xC000:
 			# if not self.rambank_initialized:
 			#	logger.error("RAM banks not initialized: 0.4x", address)
@@ -64,7 +128,7 @@ class BaseMBC:
 			if self.rtc_enabled and 0x08 <= self.rambank_selected <= 0x0C:
 				return self.rtc.getregister(self.rambank_selected)
 			else:
-				return self.rambanks[self.rambank_selected, address - 0xA000]
+				return self.ram_window[address - 0xA000]
 		# else:
 		#	logger.error("Reading address invalid: %0.4x", address)
 
@@ -93,8 +157,9 @@ class ROMOnly(BaseMBC):
 			if value == 0:
 				value = 1
 			self.rombank_selected = (value & 0b1)
+			self.update_banks()
 			logger.debug("Switching bank 0x%0.4x, 0x%0.2x", address, value)
 		elif 0xA000 <= address < 0xC000:
-			self.rambanks[self.rambank_selected, address - 0xA000] = value
+			self.ram_window[address - 0xA000] = value
 		# else:
 		#	logger.debug("Unexpected write to 0x%0.4x, value: 0x%0.2x", address, value)
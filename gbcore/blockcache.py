@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import array
+
+from . import opcodes
+
+MAX_BLOCK_LENGTH = 32 # Keeps the peripherals from falling too far behind the CPU
+BOOTROM_BANK = 0x200 # ROM banks only use 9 bits, so this can't collide with a real bank
+
+# Instructions which change PC non-linearly or change the interrupt/halt state. A block ends after these.
+BLOCK_END_MNEMONICS = ("JR", "JP", "CALL", "RET", "RETI", "RST", "HALT", "STOP", "EI", "DI")
+# Instructions with a memory operand first, which only read it
+READ_ONLY_MNEMONICS = ("JP", "AND", "OR", "XOR", "SUB", "CP")
+# Instructions with the memory operand second, which write it
+BIT_WRITE_MNEMONICS = ("SET", "RES")
+# Memory operands with an address only known at run time, which might be an I/O register
+INDIRECT_OPERANDS = ("(HL)", "(HL+)", "(HL-)", "(BC)", "(DE)", "(C)")
+
+def _ends_block(opcode):
+	mnemonic = opcodes.CPU_COMMANDS[opcode].split(" ")[0]
+	return mnemonic in BLOCK_END_MNEMONICS
+
+def _writes_memory(opcode):
+	command = opcodes.CPU_COMMANDS[opcode].split(" ")
+	if command[0] == "PUSH":
+		return True
+	if len(command) == 1:
+		return False
+	operands = command[1].split(",")
+	if command[0] in BIT_WRITE_MNEMONICS:
+		return operands[-1].startswith("(")
+	return operands[0].startswith("(") and command[0] not in READ_ONLY_MNEMONICS
+
+def _indirect_access(opcode):
+	command = opcodes.CPU_COMMANDS[opcode].split(" ")
+	if len(command) == 1 or command[0] == "JP":
+		return False
+	return any(operand in INDIRECT_OPERANDS for operand in command[1].split(","))
+
+BLOCK_END = array.array("B", [_ends_block(op) for op in range(0x200)])
+MEMORY_WRITE = array.array("B", [_writes_memory(op) for op in range(0x200)])
+INDIRECT_ACCESS = array.array("B", [_indirect_access(op) for op in range(0x200)])
+
+def _io_register(address):
+	return 0xFF00 <= address < 0xFF80 or address == 0xFFFF
+
+def _io_access(opcode, v):
+	# Peripherals are only brought up to date between blocks, so instructions accessing I/O registers at a known
+	# address have to start a new block to see the current state.
+	if opcode == 0xE0 or opcode == 0xF0: # LDH (a8),A / LDH A,(a8)
+		return _io_register(0xFF00 + v)
+	elif opcode == 0xE2 or opcode == 0xF2: # LD (C),A / LD A,(C)
+		return True
+	elif opcode == 0xEA or opcode == 0xFA: # LD (a16),A / LD A,(a16)
+		return _io_register(v)
+	return False
+
+def interpret(cpu, budget):
+	return cpu.fetch_and_execute()
+
+# 基本块缓存
+class BlockCache:
+	"""Translates straight-line runs of guest code into Python functions.
+
+	A block is decoded once from the current memory mapping, up to and including the next branch, and compiled into a
+	single function calling the opcode handlers with their operands already decoded. Blocks are keyed by ROM bank and
+	PC. Bank switches and writes to WRAM/HRAM pages holding decoded code bump `generation`, which makes a running block
+	return early, so the remaining instructions are decoded again from the new memory contents.
+
+	A block is given the cycles left until the next peripheral event, and returns as soon as they have run, so it
+	stops after the same instruction as the interpreter would. Before an instruction accessing memory through a
+	register, the cycles run so far are handed to the Mobo, as the access might bring the peripherals up to date.
+	"""
+	def __init__(self, mb):
+		self.mb = mb
+		self.blocks = {}
+		self.code_pages = array.array("B", [0] * 0x100) # Pages of RAM which have been decoded into blocks
+		self.page_blocks = {}
+		self.generation = 0
+		self.rombank0 = 0
+		self.rombank = 1
+
+	def execute(self, cpu):
+		pc = cpu.PC
+		if pc < 0x4000:
+			if self.mb.bootrom_enabled and (pc <= 0xFF or (self.mb.cgb and 0x200 <= pc < 0x900)):
+				key = (BOOTROM_BANK << 16) | pc
+			else:
+				key = (self.rombank0 << 16) | pc
+		elif pc < 0x8000:
+			key = (self.rombank << 16) | pc
+		else:
+			key = pc
+		block = self.blocks.get(key)
+		if block is None:
+			block = self.compile(pc, key)
+		return block(cpu, self.mb.cycles_to_event - self.mb.cycles_pending)
+
+	def _limit(self, pc):
+		# Returns the address where the memory region containing pc ends, or 0 if code there can't be cached
+		mb = self.mb
+		if pc < 0x4000:
+			if mb.bootrom_enabled and pc <= 0xFF:
+				return 0x100
+			elif mb.bootrom_enabled and mb.cgb and 0x200 <= pc < 0x900:
+				return 0x900
+			elif mb.bootrom_enabled and mb.cgb and pc < 0x200:
+				return 0x200
+			return 0x4000
+		elif pc < 0x8000:
+			return 0x8000
+		elif 0xC000 <= pc < 0xD000 or (0xD000 <= pc < 0xE000 and not mb.cgb):
+			return 0xE000
+		elif 0xFF80 <= pc < 0xFFFF:
+			return 0xFFFF
+		return 0
+
+	def compile(self, pc, key):
+		limit = self._limit(pc)
+		if limit == 0:
+			return interpret
+		getitem = self.mb.getitem
+		namespace = {}
+		# The cache is looked up through the CPU, so blocks can be shared by cloned machines
+		lines = ["def block(cpu, budget):", "\tcache = cpu.blockcache", "\tgeneration = cache.generation"]
+		start = pc
+		count = 0
+		while count < MAX_BLOCK_LENGTH:
+			opcode = getitem(pc)
+			if opcode == 0xCB:
+				opcode = getitem(pc + 1) + 0x100
+				oplen = 2
+			else:
+				oplen = opcodes.OPCODE_LENGTHS[opcode]
+			if oplen == 0 or pc + oplen > limit:
+				break
+			if opcode < 0x100 and oplen == 2:
+				v = getitem(pc + 1)
+			elif oplen == 3:
+				v = (getitem(pc + 2) << 8) + getitem(pc + 1)
+			else:
+				v = None
+			if count > 0 and _io_access(opcode, v):
+				break
+			handler = "op%d" % count
+			namespace[handler] = opcodes.OPCODE_HANDLERS[opcode]
+			if v is None:
+				call = "%s(cpu)" % handler
+			else:
+				call = "%s(cpu, %d)" % (handler, v)
+			sync = INDIRECT_ACCESS[opcode] or _io_access(opcode, v)
+			if count == 0:
+				lines.append("\tcycles = " + call)
+			elif sync:
+				# The access might sync the peripherals, which have to see the cycles run so far
+				lines.append("\tmb = cache.mb")
+				lines.append("\tmb.cycles_pending += cycles")
+				lines.append("\tcycles = " + call)
+			else:
+				lines.append("\tcycles += " + call)
+			pc += oplen
+			count += 1
+			if BLOCK_END[opcode]:
+				break
+			if sync:
+				# After a sync, the next event is rescheduled
+				lines.append("\tbudget = cache.mb.cycles_to_event - cache.mb.cycles_pending")
+			lines.append("\tif cycles >= budget:")
+			lines.append("\t\treturn cycles")
+			if MEMORY_WRITE[opcode]:
+				# The write might have switched bank or modified code in this block
+				lines.append("\tif cache.generation != generation:")
+				lines.append("\t\treturn cycles")
+		if count == 0:
+			# Illegal opcode. Let the interpreter deal with it.
+			block = interpret
+		else:
+			lines.append("\treturn cycles")
+			exec("\n".join(lines), namespace)
+			block = namespace["block"]
+		self.blocks[key] = block
+		if start >= 0x8000:
+			for page in range(start >> 8, (max(pc - 1, start) >> 8) + 1):
+				if not self.code_pages[page]:
+					self.code_pages[page] = 1
+					self.mb.map_wram() # Writes to the page now have to go through Mobo.setitem
+				self.page_blocks.setdefault(page, []).append(key)
+		return block
+
+	def invalidate_page(self, page):
+		# Code on this RAM page has been written to
+		for key in self.page_blocks.pop(page, ()):
+			self.blocks.pop(key, None)
+		self.code_pages[page] = 0
+		self.mb.map_wram()
+		self.generation += 1
+
+	def interrupt(self):
+		# Interrupt registers changed. Return to the CPU, so it can check for interrupts.
+		self.generation += 1
+
+	def bank_switched(self, cartridge):
+		self.rombank0, self.rombank = cartridge.getrombanks()
+		self.generation += 1
+
+	def copy_blocks(self, other):
+		# Takes over the blocks of a machine with identical memory contents, see Mobo.clone
+		self.blocks = dict(other.blocks)
+		self.page_blocks = {page: list(keys) for page, keys in other.page_blocks.items()}
+		self.code_pages[:] = other.code_pages
+		self.mb.map_wram()
+		self.generation += 1
+
+	def clear(self):
+		self.blocks.clear()
+		self.page_blocks.clear()
+		for page in range(0x100):
+			self.code_pages[page] = 0
+		self.mb.map_wram()
+		self.generation += 1
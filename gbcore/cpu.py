@@ -2,11 +2,15 @@
 #!/usr/bin/env python
 import logging as logger
 import array
+import struct
 
 from . import opcodes
+from .blockcache import BlockCache
 
 # FLAGC, FLAGH, FLAGN, FLAGZ = range(4, 8)
 INTR_VBLANK, INTR_LCDC, INTR_TIMER, INTR_SERIAL, INTR_HIGHTOLOW = [1 << x for x in range(5)]
+# A, F, B, C, D, E, HL, SP, PC, IF, IE, IME, interrupt_queued, halted, stopped
+CPU_STATE = struct.Struct("<6B3H2B4?")
 
 class CPU:
 	def set_bc(self, x):
@@ -17,7 +21,7 @@ class CPU:
 		self.D = x >> 8
 		self.E = x & 0x00FF
 
-	def __init__(self, mb):
+	def __init__(self, mb, blockcache=False):
 		# 寄存器
 		self.A = 0
 		self.F = 0
@@ -39,6 +43,8 @@ class CPU:
 		self.halted = False
 		self.stopped = False
 		self.is_stuck = False
+		# 基本块缓存
+		self.blockcache = BlockCache(mb) if blockcache else None
 
 	def tick(self):
 		if self.check_interrupts():
@@ -54,6 +60,11 @@ class CPU:
 			self.PC &= 0xFFFF
 		elif self.halted:
 			return 4 # TODO: Number of cycles for a HALT in effect?
+		if self.blockcache is not None:
+			# Blocks looping back to their own start are common, so stuck detection is only done per instruction
+			cycles = self.blockcache.execute(self)
+			self.interrupt_queued = False
+			return cycles
 		old_pc = self.PC # If the PC doesn't change, we're likely stuck
 		old_sp = self.SP # Sometimes a RET can go to the same PC, so we check the SP too.
 		cycles = self.fetch_and_execute()
@@ -69,11 +80,25 @@ class CPU:
 			opcode = self.mb.getitem(self.PC + 1)
 			opcode += 0x100 # Internally shifting look-up table
 		# logger.debug(f"Code: {opcode}, Func: {opcodes.CPU_COMMANDS[opcode]}")	
-		return opcodes.execute_opcode(self, opcode)
+		return opcodes.OPCODE_TABLE[opcode](self)
+
+	def save_state(self, f):
+		f.write(CPU_STATE.pack(self.A, self.F, self.B, self.C, self.D, self.E, self.HL, self.SP, self.PC,
+			self.interrupts_flag_register, self.interrupts_enabled_register, self.interrupt_master_enable,
+			self.interrupt_queued, self.halted, self.stopped))
+
+	def load_state(self, f, state_version):
+		(self.A, self.F, self.B, self.C, self.D, self.E, self.HL, self.SP, self.PC,
+			self.interrupts_flag_register, self.interrupts_enabled_register, self.interrupt_master_enable,
+			self.interrupt_queued, self.halted, self.stopped) = CPU_STATE.unpack(f.read(CPU_STATE.size))
+		self.is_stuck = False
 
 	def set_interruptflag(self, flag):
 		self.interrupts_flag_register |= flag
 
+	def interrupt_pending(self):
+		return (self.interrupts_flag_register & 0b11111) & (self.interrupts_enabled_register & 0b11111)
+
 	def check_interrupts(self):
 		if self.interrupt_queued:
 			# Interrupt already queued. This happens only when using a debugger.
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import logging as logger
+import struct
+
+# http://problemkaputt.de/pandocs.htm#lcdvramdmatransferscgbonly
+HDMA_BLOCK_SIZE = 0x10
+HDMA_BLOCK_CYCLES = 32 # The CPU is stopped while each 16 byte block is copied
+# hdma1-5, transfer_active, curr_src, curr_dst, hblanks
+HDMA_STATE = struct.Struct("<5B?2HQ")
+
+# CGB VRAM DMA (0xFF51-0xFF55)
+class HDMA:
+	def __init__(self):
+		self.hdma1 = 0x00 # Source, high
+		self.hdma2 = 0x00 # Source, low
+		self.hdma3 = 0x00 # Destination, high
+		self.hdma4 = 0x00 # Destination, low
+		self.hdma5 = 0xFF # Length/mode/start
+		self.transfer_active = False
+		self.curr_src = 0
+		self.curr_dst = 0
+		self.hblanks = 0 # Last HBlank count of the PPU which has been served
+
+	def save_state(self, f):
+		f.write(HDMA_STATE.pack(self.hdma1, self.hdma2, self.hdma3, self.hdma4, self.hdma5, self.transfer_active,
+			self.curr_src, self.curr_dst, self.hblanks))
+
+	def load_state(self, f, state_version):
+		(self.hdma1, self.hdma2, self.hdma3, self.hdma4, self.hdma5, self.transfer_active, self.curr_src, self.curr_dst,
+			self.hblanks) = HDMA_STATE.unpack(f.read(HDMA_STATE.size))
+
+	def set_hdma5(self, value, mb):
+		if self.transfer_active and not value & 0x80:
+			# Stops the HBlank DMA. Bit 7 reads as 1 to tell that it isn't active, the rest is the remaining length.
+			self.transfer_active = False
+			self.hdma5 |= 0x80
+			logger.debug("HDMA stopped: %0.2x", self.hdma5)
+			return
+		self.curr_src = ((self.hdma1 << 8) | self.hdma2) & 0xFFF0
+		self.curr_dst = (((self.hdma3 << 8) | self.hdma4) & 0x1FF0) | 0x8000
+		self.hdma5 = value & 0x7F
+		if value & 0x80:
+			# HBlank DMA. One block is copied at the start of each HBlank.
+			self.transfer_active = True
+			self.hblanks = mb.ppu.hblanks
+		else:
+			# General purpose DMA. Everything is copied at once.
+			blocks = self.hdma5 + 1
+			self.transfer(mb, blocks)
+			self.hdma5 = 0xFF
+			mb.cycles_pending += blocks * HDMA_BLOCK_CYCLES
+
+	def tick(self, mb):
+		# Copies one block for each HBlank the PPU has entered since the last call. Returns the cycles spent.
+		hblanks = mb.ppu.hblanks - self.hblanks
+		self.hblanks = mb.ppu.hblanks
+		if hblanks <= 0:
+			return 0
+		blocks = min(hblanks, self.hdma5 + 1)
+		self.transfer(mb, blocks)
+		if blocks > self.hdma5:
+			self.transfer_active = False
+			self.hdma5 = 0xFF
+		else:
+			self.hdma5 -= blocks
+		return blocks * HDMA_BLOCK_CYCLES
+
+	def transfer(self, mb, blocks):
+		length = min(blocks * HDMA_BLOCK_SIZE, 0xA000 - self.curr_dst) # Stops at the end of VRAM
+		mb.transfer_VRAM(self.curr_src, self.curr_dst, length)
+		self.curr_src = (self.curr_src + length) & 0xFFFF
+		self.curr_dst += length
+		if self.curr_dst >= 0xA000:
+			self.curr_dst = 0x8000
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*- 
 #!/usr/bin/env python
 
-# import PySDL2
-from sdl2.ext import get_events
-from sdl2 import *
-
 P10, P11, P12, P13 = range(4)
+DIRECTIONAL, STANDARD = range(2)
+
+# 按键
+BUTTONS = {
+	"right": (DIRECTIONAL, P10),
+	"left": (DIRECTIONAL, P11),
+	"up": (DIRECTIONAL, P12),
+	"down": (DIRECTIONAL, P13),
+	"a": (STANDARD, P10),
+	"b": (STANDARD, P11),
+	"select": (STANDARD, P12),
+	"start": (STANDARD, P13),
+}
 
 def reset_bit(x, bit):
 	return x & ~(1 << bit)
@@ -18,51 +27,31 @@ class Joypad:
 		self.directional = 0xF
 		self.standard = 0xF
 
-	def key_event(self, event):
+	def key_event(self, button, pressed):
 		_directional = self.directional
 		_standard = self.standard
-		if event.type == SDL_KEYDOWN:
-			if event.key.keysym.sym == SDLK_RIGHT:
-				self.directional = reset_bit(self.directional, P10)
-			elif event.key.keysym.sym == SDLK_LEFT:
-				self.directional = reset_bit(self.directional, P11)
-			elif event.key.keysym.sym == SDLK_UP:
-				self.directional = reset_bit(self.directional, P12)
-			elif event.key.keysym.sym == SDLK_DOWN:
-				self.directional = reset_bit(self.directional, P13)
-			elif event.key.keysym.sym == SDLK_a:
-				self.standard = reset_bit(self.standard, P10)
-			elif event.key.keysym.sym == SDLK_b:
-				self.standard = reset_bit(self.standard, P11)
-			elif event.key.keysym.sym == SDLK_BACKSPACE:
-				self.standard = reset_bit(self.standard, P12)
-			elif event.key.keysym.sym == SDLK_RETURN:
-				self.standard = reset_bit(self.standard, P13)
+		group, bit = BUTTONS[button]
+		# The bits are active low
+		if group == DIRECTIONAL:
+			if pressed:
+				self.directional = reset_bit(self.directional, bit)
 			else:
-				pass
-		elif event.type == SDL_KEYUP:
-			if event.key.keysym.sym == SDLK_RIGHT:
-				self.directional = set_bit(self.directional, P10)
-			elif event.key.keysym.sym == SDLK_LEFT:
-				self.directional = set_bit(self.directional, P11)
-			elif event.key.keysym.sym == SDLK_UP:
-				self.directional = set_bit(self.directional, P12)
-			elif event.key.keysym.sym == SDLK_DOWN:
-				self.directional = set_bit(self.directional, P13)
-			elif event.key.keysym.sym == SDLK_a:
-				self.standard = set_bit(self.standard, P10)
-			elif event.key.keysym.sym == SDLK_b:
-				self.standard = set_bit(self.standard, P11)
-			elif event.key.keysym.sym == SDLK_BACKSPACE:
-				self.standard = set_bit(self.standard, P12)
-			elif event.key.keysym.sym == SDLK_RETURN:
-				self.standard = set_bit(self.standard, P13)
+				self.directional = set_bit(self.directional, bit)
+		else:
+			if pressed:
+				self.standard = reset_bit(self.standard, bit)
 			else:
-				pass
+				self.standard = set_bit(self.standard, bit)
 		# XOR to find the changed bits, AND it to see if it was high before.
 		# Test for both directional and standard buttons.
 		return ((_directional^self.directional)&_directional) or ((_standard^self.standard)&_standard)
 
+	def save_state(self, f):
+		f.write(bytes([self.directional, self.standard]))
+
+	def load_state(self, f, state_version):
+		self.directional, self.standard = f.read(2)
+
 	def pull(self, joystickbyte):
 		P14 = (joystickbyte >> 4) & 1
 		P15 = (joystickbyte >> 5) & 1
@@ -6,9 +6,10 @@ from .base_mbc import BaseMBC
 
 class MBC1(BaseMBC):
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        # The bank registers are needed by update_banks, which is called from BaseMBC
         self.bank_select_register1 = 1
         self.bank_select_register2 = 0
+        super().__init__(*args, **kwargs)
 
     def setitem(self, address, value):
         if 0x0000 <= address < 0x2000:
@@ -20,40 +21,40 @@ class MBC1(BaseMBC):
             if value == 0:
                 value = 1
             self.bank_select_register1 = value
+            self.update_banks()
         elif 0x4000 <= address < 0x6000:
             self.bank_select_register2 = value & 0b11
+            self.update_banks()
         elif 0x6000 <= address < 0x8000:
             self.memorymodel = value & 0b1
+            self.update_banks()
         elif 0xA000 <= address < 0xC000:
             if self.rambank_enabled:
-                self.rambank_selected = self.bank_select_register2 if self.memorymodel == 1 else 0
-                self.rambanks[self.rambank_selected % self.external_ram_count, address - 0xA000] = value
+                self.ram_window[address - 0xA000] = value
         # else:
         #     logger.error("Invalid writing address: %0.4x", address)
 
-    def getitem(self, address):
-        if 0x0000 <= address < 0x4000:
-            if self.memorymodel == 1:
-                self.rombank_selected = (self.bank_select_register2 << 5) % self.external_rom_count
-            else:
-                self.rombank_selected = 0
-            return self.rombanks[self.rombank_selected, address]
-        elif 0x4000 <= address < 0x8000:
-            self.rombank_selected = \
-                    ((self.bank_select_register2 << 5) | self.bank_select_register1) % self.external_rom_count
-            return self.rombanks[self.rombank_selected, address - 0x4000]
-        elif 0xA000 <= address < 0xC000:
-            if not self.rambank_initialized:
-                logger.error("RAM banks not initialized: %0.4x", address)
+    def update_banks(self):
+        self.rombank_selected = \
+                ((self.bank_select_register2 << 5) | self.bank_select_register1) % self.external_rom_count
+        if self.memorymodel == 1:
+            self.rombank0_selected = (self.bank_select_register2 << 5) % self.external_rom_count
+            self.rambank_selected = self.bank_select_register2 % self.external_ram_count
+        else:
+            self.rombank0_selected = 0
+            self.rambank_selected = 0
+        super().update_banks()
 
-            if not self.rambank_enabled:
-                return 0xFF
+    def save_state(self, f):
+        # The bank registers go first, as loading the base state resolves the banks from them
+        f.write(bytes([self.bank_select_register1, self.bank_select_register2]))
+        super().save_state(f)
 
-            if self.memorymodel == 1:
-                self.rambank_selected = self.bank_select_register2 % self.external_ram_count
-            else:
-                self.rambank_selected = 0
-            return self.rambanks[self.rambank_selected, address - 0xA000]
-        # else:
-        #     logger.error("Reading address invalid: %0.4x", address)
+    def load_state(self, f, state_version):
+        self.bank_select_register1, self.bank_select_register2 = f.read(2)
+        super().load_state(f, state_version)
 
+    def getitem(self, address):
+        if 0xA000 <= address < 0xC000 and not self.rambank_initialized:
+            logger.error("RAM banks not initialized: %0.4x", address)
+        return super().getitem(address)
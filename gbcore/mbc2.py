@@ -15,6 +15,7 @@ class MBC2(BaseMBC):
                 if value == 0:
                     value = 1
                 self.rombank_selected = value % self.external_rom_count
+                self.update_banks()
         elif 0xA000 <= address < 0xC000:
             if self.rambank_enabled:
                 # MBC2 includes built-in RAM of 512 x 4 bits (Only the 4 LSBs are used)
@@ -24,9 +25,9 @@ class MBC2(BaseMBC):
 
     def getitem(self, address):
         if 0x0000 <= address < 0x4000:
-            return self.rombanks[0, address]
+            return self.rom_window0[address]
         elif 0x4000 <= address < 0x8000:
-            return self.rombanks[self.rombank_selected, address - 0x4000]
+            return self.rom_window1[address - 0x4000]
         elif 0xA000 <= address < 0xC000:
             if not self.rambank_initialized:
                 logger.error("RAM banks not initialized: %0.4x", address)
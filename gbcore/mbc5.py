@@ -12,13 +12,16 @@ class MBC5(BaseMBC):
         elif 0x2000 <= address < 0x3000:
             # 8-bit register used for the lower 8 bits of the ROM bank number.
             self.rombank_selected = ((self.rombank_selected & 0b100000000) | value) % self.external_rom_count
+            self.update_banks()
         elif 0x3000 <= address < 0x4000:
             # 1-bit register used for the most significant bit of the ROM bank number.
             self.rombank_selected = (((value & 0x1) << 8) | (self.rombank_selected & 0xFF)) % self.external_rom_count
+            self.update_banks()
         elif 0x4000 <= address < 0x6000:
             self.rambank_selected = (value & 0xF) % self.external_ram_count
+            self.update_banks()
         elif 0xA000 <= address < 0xC000:
             if self.rambank_enabled:
-                self.rambanks[self.rambank_selected, address - 0xA000] = value
+                self.ram_window[address - 0xA000] = value
         else:
             logger.debug("Unexpected write to 0x%0.4x, value: 0x%0.2x", address, value)
@@ -1,16 +1,14 @@
 # -*- coding: utf-8 -*- 
 #!/usr/bin/env python
 import logging as logger
-import ctypes
 import array
+import struct
+import io
 import time
 
-# import PySDL2
-from sdl2.ext import get_events
-from sdl2 import *
-
 from .cartridge import load_cartridge
 from .bootrom import BootROM
+from .dma import HDMA
 from .joypad import Joypad
 from .parameters import *
 from .sound import Sound
@@ -19,6 +17,17 @@ from .ram import RAM
 from .cpu import CPU
 from .ppu import PPU
 
+UNLIMITED = 1 << 62 # Cycle or frame count which is never reached
+
+# 存档格式
+STATE_MAGIC = b"PXBY"
+STATE_VERSION = 2
+STATE_SCREEN = 0b1 # The screen buffer is included
+# magic, version, flags, game name
+STATE_HEADER = struct.Struct("<4sBB16s")
+# bootrom_enabled, cycles_pending, clock
+MOBO_STATE = struct.Struct("<?IQ")
+
 defaults = {
 	"color_palette": (0xFFFFFF, 0x999999, 0x555555, 0x000000),
 	"cgb_color_palette": (
@@ -32,7 +41,7 @@ defaults = {
 }
 
 class Mobo:
-	def __init__(self):
+	def __init__(self, blockcache=True, headless=False):
 		self.cartridge = None
 		self.ram = None
 		self.cpu = None
@@ -47,339 +56,633 @@ class Mobo:
 		self.serialbuffer_count = 0
 		self.bootrom_enabled = True
 		self.cgb = False
-		# SDL句柄
-		self._ftime = None
-		self._window = None
-		self._sdlrenderer = None
-		self._sdltexturebuffer = None
+		# 调度器：CPU一直运行到下一个外设事件，再统一更新外设
+		self.cycles_pending = 0
+		self.cycles_to_event = 0
+		self.clock = 0 # Cycles run since power on
+		self.clock_limit = UNLIMITED
+		# 基本块缓存，关闭后逐条解释执行指令，用于对比测试
+		self.blockcache_enabled = blockcache
+		# 无界面模式：不加载SDL，不限制帧率，画面和声音通过get_framebuffer/get_audiobuffer读取
+		self.headless = headless
+		self.window = None
+		# 倒带，每帧结束时保存一次状态
+		self.rewind_buffer = None
+		# 跳帧：PPU照常运行，只是不画被跳过的帧
+		self.frame_skip = 0 # Frames skipped after each drawn one, or at most when adaptive
+		self.adaptive_frame_skip = False
+		self.frames_skipped = 0 # Skipped in a row
+		self.frame_deadline = 0 # Host time when the next frame is due, for the adaptive frame skip
 		pass
 
 	def load(self, filename):
-		self.cartridge = load_cartridge(filename)
-		logger.info(f"ROM Info:\n{self.cartridge}")
+		cartridge = load_cartridge(filename)
+		logger.info(f"ROM Info:\n{cartridge}")
+		self.__init_hardware(cartridge, BootROM(bootrom_file=None, cgb=False))
+		if not self.headless:
+			from .window import Window
+			self.window = Window(SCALE)
+
+	def clone(self):
+		# Independent copy of the running machine for branching, e.g. in a search over inputs. The ROM banks, boot ROM
+		# and decoded blocks are shared, everything else is copied through a save state. Clones are always headless,
+		# and start without a rewind buffer, but keep the render settings and frame skip.
+		mb = Mobo(self.blockcache_enabled, headless=True)
+		mb.__init_hardware(self.cartridge.clone(), self.bootrom, self.rom_pages)
+		ppu, render = self.ppu, self.ppu.render
+		mb.ppu.set_double_buffer(render.double_buffer)
+		mb.ppu.set_vectorized(render.vectorized)
+		mb.ppu.set_index_mode(render.index_mode)
+		mb.ppu.set_deferred(ppu.deferred)
+		mb.set_frame_skip(self.frame_skip, self.adaptive_frame_skip)
+		mb.frames_skipped = self.frames_skipped
+		mb.frame_deadline = self.frame_deadline
+		mb.ppu.disable_renderer = ppu.disable_renderer
+		state = io.BytesIO()
+		self.save_state(state)
+		state.seek(0)
+		mb.load_state(state)
+		if ppu.observation is not None:
+			mb.ppu.observation = ppu.observation.copy()
+		if self.cpu.blockcache is not None:
+			mb.cpu.blockcache.copy_blocks(self.cpu.blockcache)
+		return mb
+
+	def __init_hardware(self, cartridge, bootrom, rom_pages=None):
+		self.cartridge = cartridge
+		self.rom_pages = {} if rom_pages is None else rom_pages # Views of the ROM banks, by bank
 		self.timer = Timer()
 		self.ram = RAM(False, False)
-		self.cpu = CPU(self)
+		self.cpu = CPU(self, self.blockcache_enabled)
 		self.ppu = PPU(defaults["color_palette"])
-		self.bootrom = BootROM(bootrom_file=None, cgb=False)
+		self.bootrom = bootrom
 		self.joypad = Joypad()
 		# self.gui = GUI(self.cpu, self.ppu, self.joypad)
-		self.sound = Sound(True, False)
-		self.__init_sdl2()
+		self.sound = Sound(not self.headless, True)
+		self.hdma = HDMA()
+		self.init_io()
+		self.map_pages()
+		self.cartridge.bankswitch_callback = self.__bank_switched
 
 	def tick(self):
-		if self.__handle_keyboard_event() == True:
+		if self.window is not None and self.window.handle_events(self):
 			return True
-		while self.__processing_frame():
-			cycles = self.cpu.tick()
-			if self.timer.tick(cycles):
-				self.cpu.set_interruptflag(INTR_TIMER)
-			sclock = self.sound.clock
-			self.sound.clock = sclock + cycles
-			if self.timer.tick(cycles):
-				self.cpu.set_interruptflag(INTR_TIMER)
-			lcd_interrupt = self.ppu.tick(cycles)
-			if lcd_interrupt:
-				self.cpu.set_interruptflag(lcd_interrupt)
-		self.sound.sync()
+		self.run(UNLIMITED, 1)
 		self.__update_frame()
 		return False
 
-	def getitem(self, i):
-		if 0x0000 <= i < 0x4000: # 16kB ROM bank #0
-			if self.bootrom_enabled and (i <= 0xFF or (self.cgb and 0x200 <= i < 0x900)):
-				return self.bootrom.getitem(i)
-			else:
-				return self.cartridge.getitem(i)
-		elif 0x4000 <= i < 0x8000: # 16kB switchable ROM bank
-			return self.cartridge.getitem(i)
-		elif 0x8000 <= i < 0xA000: # 8kB Video RAM
-			if not self.cgb or self.ppu.vbk.active_bank == 0:
-				return self.ppu.VRAM0[i - 0x8000]
+	def run(self, cycles, frames, predicate=None):
+		# Runs until `cycles` cycles have passed, `frames` frames are done, or `predicate(self)` returns True. The
+		# predicate is checked whenever the peripherals have been brought up to date. Returns the cycles and frames run.
+		cpu = self.cpu
+		start = self.clock
+		frames_done = 0
+		self.clock_limit = self.clock + cycles
+		self.cycles_to_event = min(self.cycles_to_event, cycles)
+		self.sound.audiobuffer_head = 0
+		while True:
+			if cpu.halted and not cpu.interrupt_queued and not cpu.interrupt_pending():
+				self.__skip_halt()
 			else:
-				return self.ppu.VRAM1[i - 0x8000]
+				# Run the CPU until the next peripheral event is due, and only then bring the peripherals up to date
+				cycles = cpu.tick()
+				self.cycles_pending += cycles
+				while self.cycles_pending < self.cycles_to_event:
+					cycles = cpu.tick()
+					self.cycles_pending += cycles
+				self.sync_peripherals()
+				self.cycles_to_event = self.__cycles_to_event()
+			if self.ppu.frame_done:
+				self.ppu.frame_done = False
+				frames_done += 1
+				self.sound.sync()
+				if self.rewind_buffer is not None:
+					self.rewind_buffer.capture()
+				if self.frame_skip:
+					self.__skip_next_frame()
+				if frames_done >= frames:
+					break
+				self.sound.audiobuffer_head = 0 # Keep the samples of the last frame only
+			if self.clock >= self.clock_limit or (predicate is not None and predicate(self)):
+				break
+		self.clock_limit = UNLIMITED
+		self.sound.sync()
+		return self.clock - start, frames_done
+
+	def set_frame_skip(self, frames, adaptive=False):
+		# Draws only every (frames+1)th frame. When adaptive, frames are only skipped while the emulation is behind 60
+		# FPS, and at most `frames` in a row. The PPU runs as usual, only the pixels of skipped frames aren't drawn.
+		self.frame_skip = frames
+		self.adaptive_frame_skip = adaptive
+		self.frames_skipped = 0
+		self.frame_deadline = time.perf_counter()
+		self.ppu.disable_renderer = False
+
+	def __skip_next_frame(self):
+		if self.adaptive_frame_skip:
+			now = time.perf_counter()
+			self.frame_deadline += 1 / 60
+			if self.frame_deadline < now - self.frame_skip / 60:
+				# Too far behind to catch up, e.g. after a pause
+				self.frame_deadline = now
+			skip = self.frame_deadline < now
+		else:
+			skip = True
+		if skip and self.frames_skipped < self.frame_skip:
+			self.frames_skipped += 1
+			self.ppu.disable_renderer = True
+		else:
+			self.frames_skipped = 0
+			self.ppu.disable_renderer = False
+
+	def map_pages(self):
+		# Page table of the memory bus. Each of the 256 pages (high byte of the address) maps straight to a 256 byte
+		# view of its backing buffer, or to None when accesses need special handling (MBC, I/O, tile cache, etc.).
+		self.read_pages = [None] * 0x100
+		self.write_pages = [None] * 0x100
+		self.map_rom()
+		self.map_vram()
+		self.map_wram()
+
+	def __rom_pages(self, bank):
+		pages = self.rom_pages.get(bank)
+		if pages is None:
+			rom = self.cartridge.rom
+			pages = [rom[bank * 0x4000 + n * 0x100:bank * 0x4000 + (n + 1) * 0x100] for n in range(0x40)]
+			self.rom_pages[bank] = pages
+		return pages
+
+	def map_rom(self):
+		# Called when the MBC switches bank or the boot ROM is unmapped
+		rombank0, rombank = self.cartridge.getrombanks()
+		self.read_pages[0x00:0x40] = self.__rom_pages(rombank0)
+		self.read_pages[0x40:0x80] = self.__rom_pages(rombank)
+		if self.bootrom_enabled:
+			bootrom = memoryview(self.bootrom.bootrom)
+			self.read_pages[0x00] = bootrom[0x000:0x100]
+			if self.cgb:
+				for page in range(0x02, 0x09):
+					self.read_pages[page] = bootrom[page * 0x100:(page + 1) * 0x100]
+
+	def __bank_switched(self):
+		self.map_rom()
+		if self.cpu.blockcache is not None:
+			self.cpu.blockcache.bank_switched(self.cartridge)
+
+	def map_vram(self):
+		# Called when VBK (0xFF4F) switches bank
+		if not self.cgb or self.ppu.vbk.active_bank == 0:
+			vram = memoryview(self.ppu.VRAM0)
+		else:
+			vram = memoryview(self.ppu.VRAM1)
+		for page in range(0x80, 0xA0):
+			self.read_pages[page] = vram[(page - 0x80) * 0x100:(page - 0x7F) * 0x100]
+		# Writes to tile data has to invalidate the tile caches, tile maps can be written directly
+		for page in range(0x98, 0xA0):
+			self.write_pages[page] = self.read_pages[page]
+
+	def map_wram(self):
+		# Called when SVBK (0xFF70) switches bank, or the block cache starts or stops watching a page for code
+		wram = memoryview(self.ram.internal_ram0)
+		bank_offset = 0
+		if self.cgb:
+			# Find which bank to read from at FF70
+			bank = self.ram.non_io_internal_ram1[0xFF70 - 0xFF4C] & 0b111
+			if bank == 0x0:
+				bank = 0x01
+			bank_offset = (bank-1) * 0x1000
+		blockcache = self.cpu.blockcache
+		for page in range(0xC0, 0xE0):
+			offset = (page - 0xC0) * 0x100
+			if page >= 0xD0:
+				offset += bank_offset
+			view = wram[offset:offset + 0x100]
+			self.read_pages[page] = view
+			# Writes to code seen by the block cache has to go through setitem
+			watched = blockcache is not None and blockcache.code_pages[page]
+			self.write_pages[page] = None if watched else view
+			# Echo of 8kB Internal RAM
+			if page < 0xDE:
+				self.read_pages[page + 0x20] = view
+				self.write_pages[page + 0x20] = None if watched else view
+
+	def init_io(self):
+		# Handlers for the I/O registers at 0xFF00-0xFF7F
+		self.io_getters = [self.__get_io_port] * 0x4C + [self.__get_non_io] * 0x34
+		self.io_setters = [self.__set_io_port] * 0x4C + [self.__set_non_io] * 0x34
+		self.io_setters[0x00] = self.__set_joypad
+		self.io_setters[0x01] = self.__set_serial
+		for n in range(0x04, 0x08):
+			self.io_getters[n] = self.__get_timer
+			self.io_setters[n] = self.__set_timer
+		self.io_getters[0x0F] = self.__get_interrupt_flag
+		self.io_setters[0x0F] = self.__set_interrupt_flag
+		for n in range(0x10, 0x40):
+			self.io_getters[n] = self.__get_sound
+			self.io_setters[n] = self.__set_sound
+		for n in range(0x40, 0x4C):
+			self.io_getters[n] = self.__get_lcd
+			self.io_setters[n] = self.__set_lcd
+		self.io_setters[0x50] = self.__set_bootrom
+		if self.cgb:
+			for n in (0x4D, 0x4F, 0x51, 0x52, 0x53, 0x54, 0x55, 0x68, 0x69, 0x6A, 0x6B):
+				self.io_getters[n] = self.__get_cgb
+				self.io_setters[n] = self.__set_cgb
+			self.io_setters[0x70] = self.__set_svbk
+
+	def getitem(self, i):
+		page = self.read_pages[i >> 8]
+		if page is not None:
+			return page[i & 0xFF]
+		elif 0xFF80 <= i < 0xFFFF: # Internal RAM
+			return self.ram.internal_ram1[i - 0xFF80]
+		elif 0xFF00 <= i < 0xFF80: # I/O ports
+			return self.io_getters[i - 0xFF00](i)
 		elif 0xA000 <= i < 0xC000: # 8kB switchable RAM bank
 			return self.cartridge.getitem(i)
-		elif 0xC000 <= i < 0xE000: # 8kB Internal RAM
-			bank_offset = 0
-			if self.cgb and 0xD000 <= i:
-				# Find which bank to read from at FF70
-				bank = self.getitem(0xFF70)
-				bank &= 0b111
-				if bank == 0x0:
-					bank = 0x01
-				bank_offset = (bank-1) * 0x1000
-			return self.ram.internal_ram0[i - 0xC000 + bank_offset]
-		elif 0xE000 <= i < 0xFE00: # Echo of 8kB Internal RAM
-			# Redirect to internal RAM
-			return self.getitem(i - 0x2000)
 		elif 0xFE00 <= i < 0xFEA0: # Sprite Attribute Memory (OAM)
 			return self.ppu.OAM[i - 0xFE00]
 		elif 0xFEA0 <= i < 0xFF00: # Empty but unusable for I/O
 			return self.ram.non_io_internal_ram0[i - 0xFEA0]
-		elif 0xFF00 <= i < 0xFF4C: # I/O ports
-			if i == 0xFF04:
-				return self.timer.DIV
-			elif i == 0xFF05:
-				return self.timer.TIMA
-			elif i == 0xFF06:
-				return self.timer.TMA
-			elif i == 0xFF07:
-				return self.timer.TAC
-			elif i == 0xFF0F:
-				return self.cpu.interrupts_flag_register
-			elif 0xFF10 <= i < 0xFF40:
-				return self.sound.get(i - 0xFF10)
-			elif i == 0xFF40:
-				return self.ppu.get_lcdc()
-			elif i == 0xFF41:
-				return self.ppu.get_stat()
-			elif i == 0xFF42:
-				return self.ppu.SCY
-			elif i == 0xFF43:
-				return self.ppu.SCX
-			elif i == 0xFF44:
-				return self.ppu.LY
-			elif i == 0xFF45:
-				return self.ppu.LYC
-			elif i == 0xFF46:
-				return 0x00 # DMA
-			elif i == 0xFF47:
-				return self.ppu.BGP.get()
-			elif i == 0xFF48:
-				return self.ppu.OBP0.get()
-			elif i == 0xFF49:
-				return self.ppu.OBP1.get()
-			elif i == 0xFF4A:
-				return self.ppu.WY
-			elif i == 0xFF4B:
-				return self.ppu.WX
-			else:
-				return self.ram.io_ports[i - 0xFF00]
-		elif 0xFF4C <= i < 0xFF80: # Empty but unusable for I/O
-			# CGB registers
-			if self.cgb and i == 0xFF4D:
-				return self.key1
-			elif self.cgb and i == 0xFF4F:
-				return self.ppu.vbk.get()
-			elif self.cgb and i == 0xFF68:
-				return self.ppu.bcps.get() | 0x40
-			elif self.cgb and i == 0xFF69:
-				return self.ppu.bcpd.get()
-			elif self.cgb and i == 0xFF6A:
-				return self.ppu.ocps.get() | 0x40
-			elif self.cgb and i == 0xFF6B:
-				return self.ppu.ocpd.get()
-			elif self.cgb and i == 0xFF51:
-				# logger.debug("HDMA1 is not readable")
-				return 0x00 # Not readable
-			elif self.cgb and i == 0xFF52:
-				# logger.debug("HDMA2 is not readable")
-				return 0x00 # Not readable
-			elif self.cgb and i == 0xFF53:
-				# logger.debug("HDMA3 is not readable")
-				return 0x00 # Not readable
-			elif self.cgb and i == 0xFF54:
-				# logger.debug("HDMA4 is not readable")
-				return 0x00 # Not readable
-			elif self.cgb and i == 0xFF55:
-				return self.hdma.hdma5 & 0xFF
-			return self.ram.non_io_internal_ram1[i - 0xFF4C]
-		elif 0xFF80 <= i < 0xFFFF: # Internal RAM
-			return self.ram.internal_ram1[i - 0xFF80]
 		elif i == 0xFFFF: # Interrupt Enable Register
 			return self.cpu.interrupts_enabled_register
 		else:
 			logger.critical("Memory access violation. Tried to read: %0.4x", i)
 
+	def __get_io_port(self, i):
+		return self.ram.io_ports[i - 0xFF00]
+
+	def __get_non_io(self, i):
+		return self.ram.non_io_internal_ram1[i - 0xFF4C]
+
+	def __get_timer(self, i):
+		self.__sync_register_access()
+		if i == 0xFF04:
+			return self.timer.DIV
+		elif i == 0xFF05:
+			return self.timer.TIMA
+		elif i == 0xFF06:
+			return self.timer.TMA
+		else:
+			return self.timer.TAC
+
+	def __get_interrupt_flag(self, i):
+		self.__sync_register_access()
+		return self.cpu.interrupts_flag_register
+
+	def __get_sound(self, i):
+		self.__sync_register_access()
+		return self.sound.get(i - 0xFF10)
+
+	def __get_lcd(self, i):
+		self.__sync_register_access()
+		if i == 0xFF44:
+			return self.ppu.LY
+		elif i == 0xFF41:
+			return self.ppu.get_stat()
+		elif i == 0xFF40:
+			return self.ppu.get_lcdc()
+		elif i == 0xFF42:
+			return self.ppu.SCY
+		elif i == 0xFF43:
+			return self.ppu.SCX
+		elif i == 0xFF45:
+			return self.ppu.LYC
+		elif i == 0xFF46:
+			return 0x00 # DMA
+		elif i == 0xFF47:
+			return self.ppu.BGP.get()
+		elif i == 0xFF48:
+			return self.ppu.OBP0.get()
+		elif i == 0xFF49:
+			return self.ppu.OBP1.get()
+		elif i == 0xFF4A:
+			return self.ppu.WY
+		else:
+			return self.ppu.WX
+
+	def __get_cgb(self, i):
+		# CGB registers
+		if i == 0xFF4D:
+			return self.key1
+		elif i == 0xFF4F:
+			return self.ppu.vbk.get()
+		elif i == 0xFF68:
+			return self.ppu.bcps.get() | 0x40
+		elif i == 0xFF69:
+			return self.ppu.bcpd.get()
+		elif i == 0xFF6A:
+			return self.ppu.ocps.get() | 0x40
+		elif i == 0xFF6B:
+			return self.ppu.ocpd.get()
+		elif i == 0xFF55:
+			return self.hdma.hdma5 & 0xFF
+		else:
+			# logger.debug("HDMA1-4 is not readable")
+			return 0x00 # Not readable
+
 	def setitem(self, i, value):
-		if 0x0000 <= i < 0x4000: # 16kB ROM bank #0
-			# Doesn't change the data. This is for MBC commands
-			self.cartridge.setitem(i, value)
-		elif 0x4000 <= i < 0x8000: # 16kB switchable ROM bank
+		page = self.write_pages[i >> 8]
+		if page is not None:
+			page[i & 0xFF] = value
+		elif 0xFF80 <= i < 0xFFFF: # Internal RAM
+			self.ram.internal_ram1[i - 0xFF80] = value
+			blockcache = self.cpu.blockcache
+			if blockcache is not None and blockcache.code_pages[i >> 8]:
+				blockcache.invalidate_page(i >> 8)
+		elif 0xFF00 <= i < 0xFF80: # I/O ports
+			self.io_setters[i - 0xFF00](i, value)
+		elif 0x0000 <= i < 0x8000: # 32kB ROM banks
 			# Doesn't change the data. This is for MBC commands
 			self.cartridge.setitem(i, value)
 		elif 0x8000 <= i < 0xA000: # 8kB Video RAM
 			if not self.cgb or self.ppu.vbk.active_bank == 0:
-				self.ppu.VRAM0[i - 0x8000] = value
-				if i < 0x9800: # Is within tile data -- not tile maps
-					# Mask out the byte of the tile
-					self.ppu.render.invalidate_tile(((i & 0xFFF0) - 0x8000) // 16, 0)
+				if self.ppu.VRAM0[i - 0x8000] != value:
+					self.ppu.VRAM0[i - 0x8000] = value
+					self.ppu.changed()
+					if i < 0x9800: # Is within tile data -- not tile maps
+						# Mask out the byte of the tile
+						self.ppu.render.invalidate_tile(((i & 0xFFF0) - 0x8000) // 16, 0)
 			else:
 				self.ppu.VRAM1[i - 0x8000] = value
+				self.ppu.changed()
 				if i < 0x9800: # Is within tile data -- not tile maps
 					# Mask out the byte of the tile
 					self.ppu.renderer.invalidate_tile(((i & 0xFFF0) - 0x8000) // 16, 1)
 		elif 0xA000 <= i < 0xC000: # 8kB switchable RAM bank
 			self.cartridge.setitem(i, value)
 		elif 0xC000 <= i < 0xE000: # 8kB Internal RAM
-			bank_offset = 0
-			if self.cgb and 0xD000 <= i:
-				# Find which bank to read from at FF70
-				bank = self.getitem(0xFF70)
-				bank &= 0b111
-				if bank == 0x0:
-					bank = 0x01
-				bank_offset = (bank-1) * 0x1000
-			self.ram.internal_ram0[i - 0xC000 + bank_offset] = value
+			self.read_pages[i >> 8][i & 0xFF] = value
+			blockcache = self.cpu.blockcache
+			if blockcache is not None and blockcache.code_pages[i >> 8]:
+				blockcache.invalidate_page(i >> 8)
 		elif 0xE000 <= i < 0xFE00: # Echo of 8kB Internal RAM
 			self.setitem(i - 0x2000, value) # Redirect to internal RAM
 		elif 0xFE00 <= i < 0xFEA0: # Sprite Attribute Memory (OAM)
-			self.ppu.OAM[i - 0xFE00] = value
+			if self.ppu.OAM[i - 0xFE00] != value:
+				self.ppu.OAM[i - 0xFE00] = value
+				self.ppu.changed()
 		elif 0xFEA0 <= i < 0xFF00: # Empty but unusable for I/O
 			self.ram.non_io_internal_ram0[i - 0xFEA0] = value
-		elif 0xFF00 <= i < 0xFF4C: # I/O ports
-			if i == 0xFF00:
-				self.ram.io_ports[i - 0xFF00] = self.joypad.pull(value)
-			elif i == 0xFF01:
-				self.serialbuffer[self.serialbuffer_count] = value
-				self.serialbuffer_count += 1
-				self.serialbuffer_count &= 0x3FF
-				self.ram.io_ports[i - 0xFF00] = value
-			elif i == 0xFF04:
-				self.timer.reset()
-			elif i == 0xFF05:
-				self.timer.TIMA = value
-			elif i == 0xFF06:
-				self.timer.TMA = value
-			elif i == 0xFF07:
-				self.timer.TAC = value & 0b111 # TODO: Move logic to Timer class
-			elif i == 0xFF0F:
-				self.cpu.interrupts_flag_register = value
-			elif 0xFF10 <= i < 0xFF40:
-				self.sound.set(i - 0xFF10, value)
-			elif i == 0xFF40:
-				self.ppu.set_lcdc(value)
-			elif i == 0xFF41:
-				self.ppu.set_stat(value)
-			elif i == 0xFF42:
+		elif i == 0xFFFF: # Interrupt Enable Register
+			self.cpu.interrupts_enabled_register = value
+			if self.cpu.blockcache is not None:
+				self.cpu.blockcache.interrupt()
+		else:
+			logger.critical("Memory access violation. Tried to write: 0x%0.2x to 0x%0.4x", value, i)
+
+	def __set_io_port(self, i, value):
+		self.ram.io_ports[i - 0xFF00] = value
+
+	def __set_non_io(self, i, value):
+		self.ram.non_io_internal_ram1[i - 0xFF4C] = value
+
+	def __set_joypad(self, i, value):
+		self.ram.io_ports[i - 0xFF00] = self.joypad.pull(value)
+
+	def __set_serial(self, i, value):
+		self.serialbuffer[self.serialbuffer_count] = value
+		self.serialbuffer_count += 1
+		self.serialbuffer_count &= 0x3FF
+		self.ram.io_ports[i - 0xFF00] = value
+
+	def __set_timer(self, i, value):
+		self.__sync_register_access()
+		if i == 0xFF04:
+			self.timer.reset()
+		elif i == 0xFF05:
+			self.timer.TIMA = value
+		elif i == 0xFF06:
+			self.timer.TMA = value
+		else:
+			self.timer.TAC = value & 0b111 # TODO: Move logic to Timer class
+
+	def __set_interrupt_flag(self, i, value):
+		self.__sync_register_access()
+		self.cpu.interrupts_flag_register = value
+		if self.cpu.blockcache is not None:
+			self.cpu.blockcache.interrupt()
+
+	def __set_sound(self, i, value):
+		self.__sync_register_access()
+		self.sound.set(i - 0xFF10, value)
+
+	def __set_lcd(self, i, value):
+		self.__sync_register_access()
+		# Writes which change the picture bump the generation of the PPU, see PPU.changed
+		if i == 0xFF40:
+			if self.ppu.get_lcdc() != value:
+				self.ppu.changed()
+			self.ppu.set_lcdc(value)
+		elif i == 0xFF41:
+			self.ppu.set_stat(value)
+		elif i == 0xFF42:
+			if self.ppu.SCY != value:
 				self.ppu.SCY = value
-			elif i == 0xFF43:
+				self.ppu.changed()
+		elif i == 0xFF43:
+			if self.ppu.SCX != value:
 				self.ppu.SCX = value
-			elif i == 0xFF44:
-				self.ppu.LY = value
-			elif i == 0xFF45:
-				self.ppu.LYC = value
-			elif i == 0xFF46:
-				self.__transfer_DMA(value)
-			elif i == 0xFF47:
-				if self.ppu.BGP.set(value):
-					# TODO: Move out of MB
-					self.ppu.render.clear_tilecache0()
-			elif i == 0xFF48:
-				if self.ppu.OBP0.set(value):
-					# TODO: Move out of MB
-					self.ppu.render.clear_spritecache0()
-			elif i == 0xFF49:
-				if self.ppu.OBP1.set(value):
-					# TODO: Move out of MB
-					self.ppu.render.clear_spritecache1()
-			elif i == 0xFF4A:
+				self.ppu.changed()
+		elif i == 0xFF44:
+			self.ppu.LY = value
+		elif i == 0xFF45:
+			self.ppu.LYC = value
+		elif i == 0xFF46:
+			self.__transfer_DMA(value)
+		# The tile caches hold color codes, and the palettes are applied while drawing, so they stay valid
+		elif i == 0xFF47:
+			if self.ppu.BGP.set(value):
+				self.ppu.changed()
+		elif i == 0xFF48:
+			if self.ppu.OBP0.set(value):
+				self.ppu.changed()
+		elif i == 0xFF49:
+			if self.ppu.OBP1.set(value):
+				self.ppu.changed()
+		elif i == 0xFF4A:
+			if self.ppu.WY != value:
 				self.ppu.WY = value
-			elif i == 0xFF4B:
+				self.ppu.changed()
+		else:
+			if self.ppu.WX != value:
 				self.ppu.WX = value
-			else:
-				self.ram.io_ports[i - 0xFF00] = value
-		elif 0xFF4C <= i < 0xFF80: # Empty but unusable for I/O
-			if self.bootrom_enabled and i == 0xFF50 and (value == 0x1 or value == 0x11):
-				logger.debug("Bootrom disabled!")
-				self.bootrom_enabled = False
-			# CGB registers
-			elif self.cgb and i == 0xFF4D:
-				self.key1 = value
-			elif self.cgb and i == 0xFF4F:
-				self.ppu.vbk.set(value)
-			elif self.cgb and i == 0xFF51:
-				self.hdma.hdma1 = value
-			elif self.cgb and i == 0xFF52:
-				self.hdma.hdma2 = value # & 0xF0
-			elif self.cgb and i == 0xFF53:
-				self.hdma.hdma3 = value # & 0x1F
-			elif self.cgb and i == 0xFF54:
-				self.hdma.hdma4 = value # & 0xF0
-			elif self.cgb and i == 0xFF55:
-				self.hdma.set_hdma5(value, self)
-			elif self.cgb and i == 0xFF68:
-				self.ppu.bcps.set(value)
-			elif self.cgb and i == 0xFF69:
-				self.ppu.bcpd.set(value)
-				self.ppu.renderer.clear_tilecache0()
-				self.ppu.renderer.clear_tilecache1()
-			elif self.cgb and i == 0xFF6A:
-				self.ppu.ocps.set(value)
-			elif self.cgb and i == 0xFF6B:
-				self.ppu.ocpd.set(value)
-				self.ppu.renderer.clear_spritecache0()
-				self.ppu.renderer.clear_spritecache1()
-			else:
-				self.ram.non_io_internal_ram1[i - 0xFF4C] = value
-		elif 0xFF80 <= i < 0xFFFF: # Internal RAM
-			self.ram.internal_ram1[i - 0xFF80] = value
-		elif i == 0xFFFF: # Interrupt Enable Register
-			self.cpu.interrupts_enabled_register = value
+				self.ppu.changed()
+
+	def __set_bootrom(self, i, value):
+		if self.bootrom_enabled and (value == 0x1 or value == 0x11):
+			logger.debug("Bootrom disabled!")
+			self.bootrom_enabled = False
+			self.map_rom()
+			if self.cpu.blockcache is not None:
+				self.cpu.blockcache.clear()
 		else:
-			logger.critical("Memory access violation. Tried to write: 0x%0.2x to 0x%0.4x", value, i)
+			self.ram.non_io_internal_ram1[i - 0xFF4C] = value
+
+	def __set_svbk(self, i, value):
+		self.ram.non_io_internal_ram1[i - 0xFF4C] = value
+		self.map_wram()
+
+	def __set_cgb(self, i, value):
+		# CGB registers
+		if i == 0xFF4D:
+			self.key1 = value
+		elif i == 0xFF4F:
+			self.ppu.vbk.set(value)
+			self.map_vram()
+		elif i == 0xFF51:
+			self.hdma.hdma1 = value
+		elif i == 0xFF52:
+			self.hdma.hdma2 = value # & 0xF0
+		elif i == 0xFF53:
+			self.hdma.hdma3 = value # & 0x1F
+		elif i == 0xFF54:
+			self.hdma.hdma4 = value # & 0xF0
+		elif i == 0xFF55:
+			self.hdma.set_hdma5(value, self)
+		elif i == 0xFF68:
+			self.ppu.bcps.set(value)
+		elif i == 0xFF69:
+			self.ppu.bcpd.set(value)
+			self.ppu.changed()
+			self.ppu.renderer.clear_tilecache0()
+			self.ppu.renderer.clear_tilecache1()
+		elif i == 0xFF6A:
+			self.ppu.ocps.set(value)
+		else:
+			self.ppu.ocpd.set(value)
+			self.ppu.changed()
+			self.ppu.renderer.clear_spritecache0()
+			self.ppu.renderer.clear_spritecache1()
+
+	def sync_peripherals(self):
+		# Catch up on the cycles the CPU has run since the peripherals were last updated
+		cycles = self.cycles_pending
+		self.cycles_pending = 0
+		self.clock += cycles
+		if self.timer.tick(cycles):
+			self.cpu.set_interruptflag(INTR_TIMER)
+		self.sound.clock += cycles
+		lcd_interrupt = self.ppu.tick(cycles)
+		if lcd_interrupt:
+			self.cpu.set_interruptflag(lcd_interrupt)
+		if self.hdma.transfer_active:
+			self.cycles_pending += self.hdma.tick(self)
+
+	def __skip_halt(self):
+		# Nothing but the peripherals can wake the CPU from HALT, so instead of ticking the CPU 4 cycles at a time,
+		# jump straight to the next peripheral event.
+		self.cycles_pending += max(4, (self.cycles_to_event - self.cycles_pending + 3) & ~3)
+		self.sync_peripherals()
+		self.cycles_to_event = self.__cycles_to_event()
+
+	def __sync_register_access(self):
+		# A register is about to be accessed, which needs the current state of the peripherals. The access might also
+		# change when the next event is due, so reschedule after the current instruction.
+		self.sync_peripherals()
+		self.cycles_to_event = 0
+
+	def __cycles_to_event(self):
+		return min(self.ppu.cycles_to_event(), self.timer.cycles_to_interrupt(), self.clock_limit - self.clock)
+
+	def save_state(self, f, screen=True):
+		# Saves the whole machine into the file object `f`. The screen buffer can be left out, as it's redrawn within
+		# a frame anyway.
+		f.write(STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, STATE_SCREEN if screen else 0, self.__state_name()))
+		f.write(MOBO_STATE.pack(self.bootrom_enabled, self.cycles_pending, self.clock))
+		self.cpu.save_state(f)
+		self.timer.save_state(f)
+		self.ram.save_state(f)
+		self.ppu.save_state(f, screen)
+		self.cartridge.save_state(f)
+		self.sound.save_state(f)
+		self.joypad.save_state(f)
+		self.hdma.save_state(f)
+
+	def load_state(self, f):
+		magic, state_version, flags, name = STATE_HEADER.unpack(f.read(STATE_HEADER.size))
+		if magic != STATE_MAGIC or state_version > STATE_VERSION:
+			raise Exception("Unsupported save state (version %d)" % state_version)
+		if name != self.__state_name():
+			raise Exception("Save state is for another game: %s" % name.rstrip(b"\0").decode("latin-1"))
+		self.bootrom_enabled, self.cycles_pending, self.clock = MOBO_STATE.unpack(f.read(MOBO_STATE.size))
+		self.cpu.load_state(f, state_version)
+		self.timer.load_state(f, state_version)
+		self.ram.load_state(f, state_version)
+		self.ppu.load_state(f, state_version, bool(flags & STATE_SCREEN))
+		self.cartridge.load_state(f, state_version)
+		self.sound.load_state(f, state_version)
+		self.joypad.load_state(f, state_version)
+		self.hdma.load_state(f, state_version)
+		# Rebuild the memory map, and drop blocks decoded from the memory contents before loading
+		if self.cpu.blockcache is not None:
+			self.cpu.blockcache.clear()
+			self.cpu.blockcache.bank_switched(self.cartridge)
+		self.map_pages()
+		self.cycles_to_event = 0
+
+	def __state_name(self):
+		return self.cartridge.gamename.encode("latin-1")[:16].ljust(16, b"\0")
 
 	def getserial(self):
 		b = "".join([chr(x) for x in self.serialbuffer[:self.serialbuffer_count]])
 		self.serialbuffer_count = 0
 		return b
 
-	def __processing_frame(self):
-		b = (not self.ppu.frame_done)
-		self.ppu.frame_done = False # Clear vblank flag for next iteration
-		return b
-
 	def __transfer_DMA(self, src):
 		# http://problemkaputt.de/pandocs.htm#lcdoamdmatransfers
 		# TODO: Add timing delay of 160µs and disallow access to RAM!
-		dst = 0xFE00
-		offset = src * 0x100
-		for n in range(0xA0):
-			self.setitem(dst + n, self.getitem(n + offset))
-
-	def __init_sdl2(self):
-		# 初始化SDL
-		SDL_Init(SDL_INIT_VIDEO|SDL_INIT_GAMECONTROLLER)
-		self._ftime = time.perf_counter_ns()
-		self._window = SDL_CreateWindow(b"PixelBoy", SDL_WINDOWPOS_CENTERED, SDL_WINDOWPOS_CENTERED, COLS*SCALE, ROWS*SCALE, SDL_WINDOW_RESIZABLE)
-		self._sdlrenderer = SDL_CreateRenderer(self._window, -1, SDL_RENDERER_ACCELERATED)
-		SDL_RenderSetLogicalSize(self._sdlrenderer, COLS, ROWS)
-		self._sdltexturebuffer = SDL_CreateTexture(self._sdlrenderer, SDL_PIXELFORMAT_ABGR8888, SDL_TEXTUREACCESS_STATIC, COLS, ROWS) 
-		SDL_ShowWindow(self._window)
-		pass
+		oam = memoryview(self.ppu.OAM)
+		page = self.read_pages[src]
+		if page is not None:
+			data = page[0x00:0xA0]
+		else:
+			# Cartridge RAM, OAM and I/O aren't in the page table
+			offset = src * 0x100
+			data = bytes([self.getitem(offset + n) for n in range(0xA0)])
+		# Most games copy the same sprites every frame
+		if oam != data:
+			oam[0x00:0xA0] = data
+			self.ppu.changed()
 
-	def __handle_keyboard_event(self) -> bool:
-		event = SDL_Event()
-		while SDL_PollEvent(ctypes.byref(event)) != 0:
-			if event.type == SDL_QUIT:
-				return True	
-			elif event.type == SDL_KEYDOWN or event.type == SDL_KEYUP:
-				if self.joypad.key_event(event):
-					self.cpu.set_interruptflag(INTR_HIGHTOLOW)
+	def transfer_VRAM(self, src, dst, length):
+		# Copies `length` bytes to the current VRAM bank for CGB HDMA. Both addresses are aligned to 16 bytes, so a
+		# block never crosses a page.
+		if not self.cgb or self.ppu.vbk.active_bank == 0:
+			vram, vbank = memoryview(self.ppu.VRAM0), 0
+		else:
+			vram, vbank = memoryview(self.ppu.VRAM1), 1
+		offset = dst - 0x8000
+		for n in range(0, length, 0x10):
+			address = (src + n) & 0xFFFF
+			page = self.read_pages[address >> 8]
+			if page is not None:
+				vram[offset + n:offset + n + 0x10] = page[address & 0xF0:(address & 0xF0) + 0x10]
 			else:
-				pass
-		return False
+				vram[offset + n:offset + n + 0x10] = bytes([self.getitem(address + m) for m in range(0x10)])
+		self.ppu.changed()
+		# Invalidate the tile data in one go, tile maps don't need it
+		if offset < 0x1800:
+			self.ppu.render.invalidate_tiles(offset // 16, min(offset + length, 0x1800) // 16, vbank)
 
 	def __update_frame(self):
-		SDL_UpdateTexture(self._sdltexturebuffer, None, self.ppu.render._screenbuffer_ptr, COLS * 4)
-		SDL_RenderCopy(self._sdlrenderer, self._sdltexturebuffer, None, None)
-		SDL_RenderPresent(self._sdlrenderer)
-		SDL_RenderClear(self._sdlrenderer)
-		self.__frame_limiter(1)
-
-	def __frame_limiter(self, speed):
-		self._ftime += int((1.0 / (60.0*speed)) * 1_000_000_000)
-		now = time.perf_counter_ns()
-		if (self._ftime > now):
-			delay = (self._ftime - now) // 1_000_000
-			SDL_Delay(delay)
-		else:
-			self._ftime = now
-		return True
+		if self.window is not None:
+			if self.ppu.frame_repeat:
+				# Same picture as the last frame, so there's nothing to upload
+				self.window.update_frame(None)
+				return
+			self.ppu.render.update_rgba(self.ppu)
+			self.window.update_frame(self.ppu.render._frontbuffer_ptr)
+
+	def get_framebuffer(self):
+		# The current frame as 144x160 RGBA pixels
+		return self.ppu.get_screen_buffer()
+
+	def get_audiobuffer(self):
+		# Interleaved stereo samples (signed 8 bit) produced during the last frame. Only headless runs keep them, the
+		# window queues them to the audio device.
+		return memoryview(self.sound.audiobuffer)[:2 * self.sound.audiobuffer_head]
 
 	def __del__(self):
-		SDL_DestroyTexture(self._sdltexturebuffer)
-		SDL_DestroyRenderer(self._sdlrenderer)
-		SDL_DestroyWindow(self._window)
-		SDL_Quit()
+		if self.window is not None:
+			self.window.stop()
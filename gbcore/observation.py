@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import numpy as np
+
+from .parameters import *
+from .render import OBJ_PALETTE_FLAG
+
+# 观测
+class Observation:
+	"""Turns each finished frame into a small observation for an agent, e.g. 84x84 grayscale.
+
+	The frame is read from the palette indices of the PPU's index mode, cropped to `crop` (top, bottom, left, right),
+	mapped to grayscale (or kept as shade indices), and downsampled to `size` (height, width). Integer factors are
+	averaged over the pixel blocks, other sizes use the nearest pixel. The last `stack` observations are kept in
+	`frames`, oldest first, which is updated in place every `interval` frames.
+	"""
+	def __init__(self, size=(84, 84), crop=(0, ROWS, 0, COLS), grayscale=True, stack=1, interval=1):
+		self.top, self.bottom, self.left, self.right = crop
+		self.height, self.width = size
+		self.grayscale = grayscale
+		self.interval = interval
+		self.frame_count = 0
+		self.frames = np.zeros((stack, self.height, self.width), dtype=np.uint8)
+		crop_height = self.bottom - self.top
+		crop_width = self.right - self.left
+		self._pixels = np.zeros((crop_height, crop_width), dtype=np.uint8)
+		if crop_height % self.height == 0 and crop_width % self.width == 0:
+			self._blocks = self._pixels.reshape(self.height, crop_height // self.height, self.width,
+				crop_width // self.width)
+			self._mean = np.zeros((self.height, self.width), dtype=np.float32)
+		else:
+			self._blocks = None
+			self._rows = ((np.arange(self.height) + 0.5) * crop_height / self.height).astype(np.intp)
+			self._cols = ((np.arange(self.width) + 0.5) * crop_width / self.width).astype(np.intp)
+			self._row_pixels = np.zeros((self.height, crop_width), dtype=np.uint8)
+		self._lut = np.zeros(256, dtype=np.uint8)
+		self._lut_colors = None
+
+	def copy(self):
+		# Same settings and stacked frames, e.g. for a cloned machine
+		observation = Observation((self.height, self.width), (self.top, self.bottom, self.left, self.right),
+			self.grayscale, len(self.frames), self.interval)
+		observation.frames[:] = self.frames
+		observation.frame_count = self.frame_count
+		return observation
+
+	def frame_done(self, lcd):
+		# Called by the PPU when a frame is done
+		self.frame_count += 1
+		if self.frame_count % self.interval == 0:
+			self.update(lcd)
+
+	def reset(self, lcd):
+		# Fills the whole stack with the current frame, e.g. at the start of an episode
+		self.frame_count = 0
+		self.update(lcd)
+		self.frames[:-1] = self.frames[-1]
+
+	def update(self, lcd):
+		indices = lcd.get_screen_indices()[self.top:self.bottom, self.left:self.right]
+		if self.grayscale:
+			self.__update_lut(lcd)
+			np.take(self._lut, indices, out=self._pixels)
+		else:
+			np.copyto(self._pixels, indices)
+		# Move the older observations down the stack, and write the new one at the end
+		self.frames[:-1] = self.frames[1:]
+		if self._blocks is not None:
+			self._blocks.mean(axis=(1, 3), out=self._mean)
+			np.copyto(self.frames[-1], self._mean, casting="unsafe")
+		else:
+			np.take(self._pixels, self._rows, axis=0, out=self._row_pixels)
+			np.take(self._row_pixels, self._cols, axis=1, out=self.frames[-1])
+
+	def __update_lut(self, lcd):
+		# Luma of the colors behind each palette index. Only the CGB palettes change while running.
+		if lcd.render.cgb:
+			colors = [lcd.bcpd.getcolor(i >> 2, i & 0b11) for i in range(32)] + \
+				[lcd.ocpd.getcolor(i >> 2, i & 0b11) for i in range(32)]
+		else:
+			colors = lcd.BGP.palette_mem_rgb
+		if colors == self._lut_colors:
+			return
+		self._lut_colors = list(colors)
+		self._lut[:] = 0
+		for i, color in enumerate(colors):
+			# ABGR, as in the screen buffer
+			r, g, b = color & 0xFF, (color >> 8) & 0xFF, (color >> 16) & 0xFF
+			self._lut[i if i < 32 else OBJ_PALETTE_FLAG | (i - 32)] = (r * 299 + g * 587 + b * 114) // 1000
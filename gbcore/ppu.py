@@ -2,10 +2,20 @@
 #!/usr/bin/env python
 import logging as logger
 import array
+import struct
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 from .parameters import *
 from .render import *
 
+# LCDC, STAT, STAT mode, SCY, SCX, LY, LYC, WY, WX, BGP, OBP0, OBP1, next_stat_mode, clock, clock_target, frame_done,
+# hblanks
+PPU_STATE = struct.Struct("<13B2i?Q")
+
 def rgb_to_bgr(color):
 	a = 0xFF
 	r = (color >> 16) & 0xFF
@@ -90,12 +100,55 @@ class PaletteRegister:
 	def getcolor(self, i):
 		return self.palette_mem_rgb[self.lookup[i]]
 
+# 延迟渲染
+class DeferredLCD:
+	# Stands in for the PPU while the recorded lines are drawn at VBlank, with the registers and memory each line saw
+	def __init__(self, lcd):
+		self.VRAM0 = array.array("B", lcd.VRAM0)
+		self.OAM = array.array("B", lcd.OAM)
+		self._LCDC = LCDCRegister(0)
+		self.BGP = PaletteRegister(0)
+		self.BGP.palette_mem_rgb = lcd.BGP.palette_mem_rgb
+		self.OBP0 = PaletteRegister(0)
+		self.OBP0.palette_mem_rgb = lcd.OBP0.palette_mem_rgb
+		self.OBP1 = PaletteRegister(0)
+		self.OBP1.palette_mem_rgb = lcd.OBP1.palette_mem_rgb
+		self.SCY = self.SCX = self.WY = self.WX = 0
+		self.registers = None
+		self.disable_renderer = False
+
+	def set_registers(self, registers):
+		if registers == self.registers:
+			return
+		self.registers = registers
+		self.SCX, self.SCY, self.WX, self.WY, lcdc, bgp, obp0, obp1 = registers
+		self._LCDC.set(lcdc)
+		self.BGP.set(bgp)
+		self.OBP0.set(obp0)
+		self.OBP1.set(obp1)
+
+	def set_memory(self, vram, oam, render):
+		# Tiles which differ from the last memory are invalidated in the caches of the renderer
+		tiledata = memoryview(self.VRAM0)[:0x1800]
+		if tiledata != vram[:0x1800]:
+			for tile in range(TILES):
+				if tiledata[tile * 16:tile * 16 + 16] != vram[tile * 16:tile * 16 + 16]:
+					render.invalidate_tile(tile, 0)
+		memoryview(self.VRAM0)[:] = vram
+		memoryview(self.OAM)[:] = oam
+
+	def getwindowpos(self):
+		return (self.WX - 7, self.WY)
+
+	def getviewport(self):
+		return (self.SCX, self.SCY)
+
 # GameBoy图像处理器
 class PPU:
 	def __init__(self, color_palette):
 		# 显存
-		self.VRAM0 = array.array("B", [0] * VIDEO_RAM)
-		self.OAM = array.array("B", [0] * OBJECT_ATTRIBUTE_MEMORY)
+		self.VRAM0 = array.array("B", bytes(VIDEO_RAM))
+		self.OAM = array.array("B", bytes(OBJECT_ATTRIBUTE_MEMORY))
 		# 寄存器
 		self._LCDC = LCDCRegister(0)
 		self._STAT = STATRegister() # Bit 7 is always set.
@@ -119,8 +172,25 @@ class PPU:
 		self.clock = 0
 		self.clock_target = 0
 		self.frame_done = False
+		self.hblanks = 0 # Number of HBlanks entered, for HBlank DMA
 		# 渲染引擎
 		self.render = Render(False)
+		self.observation = None # Updated whenever a frame is done, see set_observation
+		# 画面变化检测：改变画面的写入都会增加generation，和上一帧画这一行时相同就不用重画
+		self.generation = 0
+		self.line_generation = [-1] * ROWS # Generation each line was last drawn with
+		self.lines_drawn = 0 # Lines drawn in the current frame
+		self.frame_repeat = False # The last frame didn't change the screen buffer
+		self.blank_generation = -1
+		# The tile maps are written straight through the page table, so they are compared instead
+		self.tilemaps = memoryview(self.VRAM0)[0x1800:0x2000]
+		self.tilemaps_drawn = bytes(self.tilemaps)
+		# 延迟渲染：HBlank时只记录，VBlank时一次画完整帧
+		self.deferred = False
+		self.deferred_lines = [] # (y, draw, registers, memory) of the lines waiting to be drawn
+		self.deferred_lcd = None
+		self.memory = None # VRAM and OAM as of the last change
+		self.memory_generation = -1
 
 	def tick(self, cycles):
 		interrupt_flag = 0
@@ -152,8 +222,8 @@ class PPU:
 					self.next_stat_mode = 0
 				elif self._STAT._mode == 0: # HBLANK
 					self.clock_target += 206 * multiplier
-					self.render.scanline(self, self.LY)
-					self.render.scanline_sprites(self, self.LY, self.render._screenbuffer, self.render._screenbuffer_attributes, False)
+					self.hblanks += 1
+					self.draw_line(self.LY)
 					if self.LY < 143:
 						self.next_stat_mode = 2
 					else:
@@ -166,6 +236,12 @@ class PPU:
 					if self.LY == 144:
 						interrupt_flag |= INTR_VBLANK
 						self.frame_done = True
+						self.draw_deferred()
+						self.frame_repeat = self.lines_drawn == 0
+						self.lines_drawn = 0
+						self.render.present()
+						if self.observation is not None:
+							self.observation.frame_done(self)
 					if self.LY == 153:
 						# Reset to new frame and start from mode 2
 						self.next_stat_mode = 2
@@ -175,9 +251,90 @@ class PPU:
 				self.frame_done = True
 				self.clock %= FRAME_CYCLES
 				# Renderer
-				self.render.blank_screen(self)
+				self.draw_deferred()
+				self.frame_repeat = self.blank_generation == self.generation
+				if not self.frame_repeat:
+					self.render.blank_screen(self)
+					self.blank_generation = self.generation
+				self.render.present()
+				if self.observation is not None:
+					self.observation.frame_done(self)
 		return interrupt_flag
 
+	def changed(self):
+		# Called for every write which can change the picture: VRAM, OAM, palettes, scrolling, window and LCDC
+		self.generation += 1
+
+	def draw_line(self, y):
+		if self.tilemaps != self.tilemaps_drawn:
+			self.tilemaps_drawn = bytes(self.tilemaps)
+			self.generation += 1
+		if self.line_generation[y] == self.generation:
+			# Nothing changed since this line was drawn a frame ago
+			if self.deferred:
+				self.deferred_lines.append((y, False, self.line_registers(), None))
+			else:
+				self.render.skip_line(self, y)
+			return
+		if self.deferred and not self.disable_renderer:
+			if self.memory_generation != self.generation:
+				# VRAM or OAM may have changed, so the lines from here on need their own copy
+				self.memory = (bytes(self.VRAM0), bytes(self.OAM))
+				self.memory_generation = self.generation
+			self.deferred_lines.append((y, True, self.line_registers(), self.memory))
+			self.line_generation[y] = self.generation
+			self.lines_drawn += 1
+			return
+		self.render.scanline(self, y)
+		self.render.scanline_sprites(self, y, self.render._outputbuffer, self.render._screenbuffer_attributes, False)
+		if not self.disable_renderer:
+			self.line_generation[y] = self.generation
+			self.lines_drawn += 1
+
+	def line_registers(self):
+		return (self.SCX, self.SCY, self.WX, self.WY, self._LCDC.value, self.BGP.value, self.OBP0.value,
+			self.OBP1.value)
+
+	def set_deferred(self, enabled):
+		# When deferred, the lines are only recorded during the frame, and all of them are drawn at once at VBlank. The
+		# registers of each line are kept, and VRAM and OAM are copied at the lines where they changed, so raster
+		# effects look the same as when drawing each line at its HBlank.
+		if enabled == self.deferred:
+			return
+		if enabled:
+			self.deferred_lcd = DeferredLCD(self)
+		else:
+			self.draw_deferred()
+			# The caches may hold tiles from an older copy of VRAM
+			self.deferred_lcd.set_memory(bytes(self.VRAM0), bytes(self.OAM), self.render)
+			self.deferred_lcd = None
+			self.memory = None
+			self.memory_generation = -1
+		self.deferred = enabled
+
+	def draw_deferred(self):
+		if not self.deferred_lines:
+			return
+		lcd = self.deferred_lcd
+		memory = None
+		for y, draw, registers, line_memory in self.deferred_lines:
+			lcd.set_registers(registers)
+			if not draw:
+				self.render.skip_line(lcd, y)
+				continue
+			if line_memory is not memory:
+				memory = line_memory
+				lcd.set_memory(memory[0], memory[1], self.render)
+			self.render.scanline(lcd, y)
+			self.render.scanline_sprites(lcd, y, self.render._outputbuffer, self.render._screenbuffer_attributes, False)
+		self.deferred_lines.clear()
+
+	def cycles_to_event(self):
+		# Cycles until the next mode change, or the next blank frame when the LCD is off
+		if self._LCDC.lcd_enable:
+			return self.clock_target - self.clock
+		return FRAME_CYCLES - self.clock
+
 	def get_stat(self):
 		return self._STAT.value
 
@@ -201,6 +358,81 @@ class PPU:
 			self.next_stat_mode = 2
 			self.LY = 0
 
+	def save_state(self, f, screen=True):
+		# The recorded lines aren't part of the state, so they are drawn now
+		self.draw_deferred()
+		f.write(PPU_STATE.pack(self._LCDC.value, self._STAT.value, self._STAT._mode, self.SCY, self.SCX, self.LY, self.LYC,
+			self.WY, self.WX, self.BGP.value, self.OBP0.value, self.OBP1.value, self.next_stat_mode, self.clock,
+			self.clock_target, self.frame_done, self.hblanks))
+		f.write(self.VRAM0)
+		f.write(self.OAM)
+		self.render.save_state(f, screen)
+
+	def load_state(self, f, state_version, screen=True):
+		(lcdc, self._STAT.value, self._STAT._mode, self.SCY, self.SCX, self.LY, self.LYC, self.WY, self.WX, bgp, obp0,
+			obp1, self.next_stat_mode, self.clock, self.clock_target, self.frame_done,
+			self.hblanks) = PPU_STATE.unpack(f.read(PPU_STATE.size))
+		# Rebuild the decoded register fields
+		self._LCDC.set(lcdc)
+		self.BGP.set(bgp)
+		self.OBP0.set(obp0)
+		self.OBP1.set(obp1)
+		f.readinto(self.VRAM0)
+		f.readinto(self.OAM)
+		self.render.load_state(f, state_version, screen)
+		self.deferred_lines.clear()
+		self.memory_generation = -1
+		self.changed()
+
+	def set_double_buffer(self, enabled):
+		# With double buffering, the buffers returned by `get_screen` hold the last finished frame, and aren't touched
+		# while the next one is drawn. Without it, they are the live buffer the renderer draws into.
+		self.render.set_double_buffer(enabled)
+
+	def set_vectorized(self, enabled):
+		# Draws the scanlines with NumPy instead of pure Python. The pixels are the same.
+		self.render.set_vectorized(enabled)
+
+	def set_index_mode(self, enabled):
+		# Draws 1 byte per pixel instead of RGBA: the DMG shade (0-3) after the palette register, or on CGB the palette
+		# and color code (see OBJ_PALETTE_FLAG). The RGBA screen is then only converted when it's asked for.
+		if not enabled:
+			self.render.update_rgba(self)
+		self.render.set_index_mode(enabled)
+		self.changed()
+
+	def set_observation(self, observation):
+		# Attaches an Observation (see observation.py), which is built from the palette indices at the end of every
+		# frame. None detaches it.
+		self.observation = observation
+		if observation is not None:
+			self.set_index_mode(True)
+			observation.reset(self)
+
+	def get_screen_indices(self):
+		# The (144, 160) palette indices of the index mode, as a NumPy array when NumPy is installed
+		if np is None:
+			return memoryview(self.render._frontindex_raw).cast("B", shape=(ROWS, COLS))
+		return np.frombuffer(self.render._frontindex_raw, dtype=np.uint8).reshape(ROWS, COLS)
+
+	def get_screen_buffer(self):
+		# 144x160 RGBA pixels, as a memoryview of the screen buffer without copying
+		self.render.update_rgba(self)
+		return memoryview(self.render._frontbuffer_raw).cast("B", shape=(ROWS, COLS, 4))
+
+	def get_screen(self):
+		# Same as `get_screen_buffer`, but a (144, 160, 4) uint8 NumPy array when NumPy is installed. Both stay valid
+		# until double buffering is switched. They follow the screen, except in index mode, where the RGBA pixels are
+		# only converted by these calls or `update_screen`, so one of them has to be called again for each frame.
+		if np is None:
+			return self.get_screen_buffer()
+		self.render.update_rgba(self)
+		return np.frombuffer(self.render._frontbuffer_raw, dtype=np.uint8).reshape(ROWS, COLS, 4)
+
+	def update_screen(self):
+		# Brings the RGBA screen returned by `get_screen` up to date in index mode, without making a new view
+		self.render.update_rgba(self)
+
 	def getwindowpos(self):
 		return (self.WX - 7, self.WY)
 
@@ -14,7 +14,7 @@ INTERNAL_RAM1 = 0x7F
 class RAM:
 	def __init__(self, cgb, randomize=False):
 		self.cgb = cgb
-		self.internal_ram0 = array.array("B", [0] * (INTERNAL_RAM0_CGB if cgb else INTERNAL_RAM0))
+		self.internal_ram0 = array.array("B", bytes(INTERNAL_RAM0_CGB if cgb else INTERNAL_RAM0))
 		self.non_io_internal_ram0 = array.array("B", [0] * (NON_IO_INTERNAL_RAM0))
 		self.io_ports = array.array("B", [0] * (IO_PORTS))
 		self.internal_ram1 = array.array("B", [0] * (INTERNAL_RAM1))
@@ -29,4 +29,16 @@ class RAM:
 			for n in range(NON_IO_INTERNAL_RAM1):
 				self.non_io_internal_ram1[n] = random.getrandbits(8)
 
+	def save_state(self, f):
+		f.write(self.internal_ram0)
+		f.write(self.non_io_internal_ram0)
+		f.write(self.io_ports)
+		f.write(self.internal_ram1)
+		f.write(self.non_io_internal_ram1)
 
+	def load_state(self, f, state_version):
+		f.readinto(self.internal_ram0)
+		f.readinto(self.non_io_internal_ram0)
+		f.readinto(self.io_ports)
+		f.readinto(self.internal_ram1)
+		f.readinto(self.non_io_internal_ram1)
@@ -3,40 +3,222 @@
 import random
 import ctypes
 import array
+import struct
 
 COL0_FLAG = 0b01
 BG_PRIORITY_FLAG = 0b10
+# In the palette index mode, CGB pixels are (palette << 2 | color code), and sprites have this flag set
+OBJ_PALETTE_FLAG = 0b100000
 ROWS, COLS = 144, 160
 TILES = 384
 
+def _decode_table():
+	# The 8 color codes of a tile row for each pair of bytes, indexed by (byte2 << 8 | byte1) * 8. The colors are 2 bit,
+	# byte1 holding the low bits and byte2 the high bits, with the leftmost pixel in bit 7:
+	# 1 0 0 1 0 0 0 1 <- byte1
+	# 0 1 1 1 1 1 0 0 <- byte2
+	# 1 2 2 3 2 2 0 1 <- color codes
+	# Each bit of a byte is spread to its own byte first, the leftmost pixel being the lowest byte.
+	spread = [sum(((b >> (7 - x)) & 1) << (8 * x) for x in range(8)) for b in range(256)]
+	return b"".join([(spread[byte1] | spread[byte2] << 1).to_bytes(8, "little")
+		for byte2 in range(256) for byte1 in range(256)])
+
+# 2bpp解码表
+TILE_ROW_TABLE = array.array("B", _decode_table())
+# Translates color codes to COL0_FLAG attributes
+COL0_TABLE = bytes([COL0_FLAG]) + bytes(255)
+
+class TileLayer:
+	"""The whole 256x256 pixel map at `base` (0x1800 or 0x1C00 in VRAM) as color codes, one byte per pixel.
+
+	Each of the 32x32 map entries is only drawn again when the map entry itself or its tile data has changed. Changes
+	to the map are found by comparing a map row with the copy it was drawn from, changes to the tile data are passed to
+	`invalidate_tiles`. `signed` is the addressing mode of the tile data (LCDC bit 4 cleared).
+	"""
+	def __init__(self, base, signed):
+		self.base = base
+		self.signed = signed
+		self.codes = bytearray(256 * 256)
+		self.drawn = bytearray(32 * 32) # Map entries the codes were drawn from
+		self.dirty = bytearray(b"\x01" * (32 * 32))
+		self.dirty_rows = bytearray(b"\x01" * 32)
+
+	def invalidate_tiles(self, tiles):
+		for tile in tiles:
+			# The map entry pointing to the tile
+			if self.signed:
+				if tile < 128:
+					continue
+				entry = (tile - 128) ^ 0x80
+			elif tile < 256:
+				entry = tile
+			else:
+				continue
+			i = self.drawn.find(entry)
+			while i >= 0:
+				self.dirty[i] = 1
+				self.dirty_rows[i >> 5] = 1
+				i = self.drawn.find(entry, i + 1)
+
+	def row(self, vram, y):
+		# Brings the map row of pixel row y up to date, and returns the offset of the pixel row in `codes`
+		ty = y >> 3
+		start = self.base + ty * 32
+		entries = memoryview(vram)[start:start + 32]
+		if self.dirty_rows[ty] or entries != self.drawn[ty * 32:ty * 32 + 32]:
+			for tx in range(32):
+				i = ty * 32 + tx
+				entry = entries[tx]
+				if self.dirty[i] or entry != self.drawn[i]:
+					self.draw(vram, i, entry)
+			self.dirty_rows[ty] = 0
+		return y * 256
+
+	def draw(self, vram, i, entry):
+		tile = (entry ^ 0x80) + 128 if self.signed else entry
+		offset = (i >> 5) * 8 * 256 + (i & 31) * 8
+		for k in range(0, 16, 2):
+			key = (vram[tile*16 + k] | vram[tile*16 + k + 1] << 8) * 8
+			self.codes[offset:offset + 8] = TILE_ROW_TABLE[key:key + 8]
+			offset += 256
+		self.drawn[i] = entry
+		self.dirty[i] = 0
+
 class Render:
 	def __init__(self, cgb):
 		self.cgb = cgb
 		self.color_format = "RGBA"
 		self.buffer_dims = (ROWS, COLS)
 		# Init buffers as white
-		self._screenbuffer_raw = array.array("B", [0x00] * (ROWS*COLS*4))
-		self._screenbuffer_attributes_raw = array.array("B", [0x00] * (ROWS*COLS))
-		self._tilecache0_raw = array.array("B", [0x00] * (TILES*8*8*4))
-		self._spritecache0_raw = array.array("B", [0x00] * (TILES*8*8*4))
-		self._spritecache1_raw = array.array("B", [0x00] * (TILES*8*8*4))
-		self.sprites_to_render = array.array("i", [0] * 10)
+		self._screenbuffer_raw = array.array("B", bytes(ROWS*COLS*4))
+		self._screenbuffer_attributes_raw = array.array("B", bytes(ROWS*COLS))
+		# 调色板索引模式：每个像素1字节，RGBA在需要显示时才转换
+		self.index_mode = False
+		self._indexbuffer_raw = array.array("B", bytes(ROWS*COLS))
+		self._frontindex_raw = self._indexbuffer_raw
+		self._rgba_stale = False
+		# One byte per color code. The codes don't depend on the palettes, so on DMG the background and both sprite
+		# palettes share the tiles decoded from VRAM bank 0.
+		self._tilecache0_raw = array.array("B", bytes(TILES*8*8))
+		self._spritecache0_raw = self._tilecache0_raw
+		self._spritecache1_raw = array.array("B", bytes(TILES*8*8)) if cgb else self._tilecache0_raw
+		# 精灵索引：每行要画的精灵，OAM不变时重复使用
+		self._sprite_lines = None
+		self._sprite_oam = None # OAM the index was built from
+		self._sprite_height = 0
 		self._tilecache0_state = array.array("B", [0] * TILES)
-		self._spritecache0_state = array.array("B", [0] * TILES)
-		self._spritecache1_state = array.array("B", [0] * TILES)
+		self._spritecache0_state = self._tilecache0_state
+		self._spritecache1_state = array.array("B", [0] * TILES) if cgb else self._tilecache0_state
+		# 图层缓存：每个tile map一张256x256的图，只重画改动过的tile
+		self._layers = {} # TileLayer by tile map and addressing mode
+		self._dirty_tiles = set() # Tiles written since the layers were last brought up to date
 		self.clear_cache()
 		# 内存条带化
 		self._screenbuffer = memoryview(self._screenbuffer_raw).cast("I", shape=(ROWS, COLS))
 		self._screenbuffer_attributes = memoryview(self._screenbuffer_attributes_raw).cast("B", shape=(ROWS, COLS))
-		self._tilecache0 = memoryview(self._tilecache0_raw).cast("I", shape=(TILES * 8, 8))
+		self._indexbuffer = memoryview(self._indexbuffer_raw).cast("B", shape=(ROWS, COLS))
+		# Flat byte views, for writing whole lines
+		self._screenbuffer_bytes = memoryview(self._screenbuffer_raw)
+		self._indexbuffer_bytes = memoryview(self._indexbuffer_raw)
+		self._screenbuffer_attributes_bytes = memoryview(self._screenbuffer_attributes_raw)
+		# Translation tables from color codes to the bytes of the output, for the current BGP and output mode
+		self._line_tables = None
+		self._line_palette = None
+		self._outputbuffer = self._screenbuffer # The buffer the scanlines are drawn into
+		self._tilecache0 = memoryview(self._tilecache0_raw).cast("B", shape=(TILES * 8, 8))
 		# OBP0 palette
-		self._spritecache0 = memoryview(self._spritecache0_raw).cast("I", shape=(TILES * 8, 8))
+		self._spritecache0 = memoryview(self._spritecache0_raw).cast("B", shape=(TILES * 8, 8))
 		# OBP1 palette
-		self._spritecache1 = memoryview(self._spritecache1_raw).cast("I", shape=(TILES * 8, 8))
+		self._spritecache1 = memoryview(self._spritecache1_raw).cast("B", shape=(TILES * 8, 8))
 		self._screenbuffer_ptr = ctypes.c_void_p(self._screenbuffer_raw.buffer_info()[0])
+		# 双缓冲：关闭时前台缓冲就是屏幕缓冲本身，打开时每帧结束复制一次
+		self.double_buffer = False
+		self._frontbuffer_raw = self._screenbuffer_raw
+		self._frontbuffer_ptr = self._screenbuffer_ptr
+		self.vectorized = False
 		self._scanlineparameters = [[0, 0, 0, 0, 0] for _ in range(ROWS)]
 		self.ly_window = 0
 
+	def save_state(self, f, screen=True):
+		f.write(struct.pack("<i", self.ly_window))
+		if screen:
+			f.write(self._screenbuffer_raw)
+			f.write(self._screenbuffer_attributes_raw)
+			f.write(self._indexbuffer_raw)
+
+	def load_state(self, f, state_version, screen=True):
+		self.ly_window, = struct.unpack("<i", f.read(4))
+		if screen:
+			f.readinto(self._screenbuffer_raw)
+			f.readinto(self._screenbuffer_attributes_raw)
+			if state_version >= 2:
+				f.readinto(self._indexbuffer_raw)
+			self.present()
+		# The tile caches are derived from VRAM and the palettes, so they are rebuilt on demand
+		self.clear_cache()
+
+	def set_double_buffer(self, enabled):
+		self.double_buffer = enabled
+		if enabled and self._frontbuffer_raw is self._screenbuffer_raw:
+			self._frontbuffer_raw = array.array("B", self._screenbuffer_raw)
+			self._frontindex_raw = array.array("B", self._indexbuffer_raw)
+		elif not enabled:
+			self._frontbuffer_raw = self._screenbuffer_raw
+			self._frontindex_raw = self._indexbuffer_raw
+		self._frontbuffer_ptr = ctypes.c_void_p(self._frontbuffer_raw.buffer_info()[0])
+
+	def set_vectorized(self, enabled):
+		# Switches between drawing the scanlines pixel by pixel, and with NumPy (see render_numpy.py). The instance
+		# attributes shadow the methods of this class.
+		self.vectorized = enabled
+		if enabled:
+			from .render_numpy import VectorizedRender
+			vectorized = VectorizedRender(self)
+			self.scanline = vectorized.scanline
+			self.scanline_sprites = vectorized.scanline_sprites
+		else:
+			self.__dict__.pop("scanline", None)
+			self.__dict__.pop("scanline_sprites", None)
+
+	def set_index_mode(self, enabled):
+		self.index_mode = enabled
+		self._outputbuffer = self._indexbuffer if enabled else self._screenbuffer
+		self._rgba_stale = enabled
+
+	def present(self):
+		# Called when a frame is done. With double buffering, the finished frame is copied to the front buffer in one
+		# go, so it can be read while the next frame is drawn.
+		if self.index_mode:
+			if self._frontindex_raw is not self._indexbuffer_raw:
+				self._frontindex_raw[:] = self._indexbuffer_raw
+			self._rgba_stale = True
+		elif self._frontbuffer_raw is not self._screenbuffer_raw:
+			self._frontbuffer_raw[:] = self._screenbuffer_raw
+
+	def update_rgba(self, lcd):
+		# Converts the palette indices of the front buffer to RGBA, if they changed since the last time
+		if not self._rgba_stale:
+			return
+		self._rgba_stale = False
+		colors = [0] * 256
+		if self.cgb:
+			for i in range(32):
+				colors[i] = lcd.bcpd.getcolor(i >> 2, i & 0b11)
+				colors[OBJ_PALETTE_FLAG | i] = lcd.ocpd.getcolor(i >> 2, i & 0b11)
+		else:
+			colors[:4] = lcd.BGP.palette_mem_rgb
+		indices = bytes(self._frontindex_raw)
+		# One translation per byte of the 32-bit pixels
+		for c in range(4):
+			table = bytes((color >> (8 * c)) & 0xFF for color in colors)
+			self._frontbuffer_raw[c::4] = array.array("B", indices.translate(table))
+
+	def _cgb_color_index(self, palette, color_code):
+		return palette << 2 | color_code
+
+	def _cgb_sprite_color_index(self, palette, color_code):
+		return OBJ_PALETTE_FLAG | palette << 2 | color_code
+
 	def _cgb_get_background_map_attributes(self, lcd, i):
 		tile_num = lcd.VRAM1[i]
 		palette = tile_num & 0b111
@@ -57,6 +239,16 @@ class Render:
 		self._scanlineparameters[y][4] = lcd._LCDC.tiledata_select
 		if lcd.disable_renderer:
 			return
+		# Either RGBA colors, or the palette indices, which skips the palette memory
+		buffer = self._outputbuffer
+		if self.index_mode:
+			bgcolor = lcd.BGP.lookup.__getitem__
+			if self.cgb:
+				cgbcolor = self._cgb_color_index
+		else:
+			bgcolor = lcd.BGP.getcolor
+			if self.cgb:
+				cgbcolor = lcd.bcpd.getcolor
 		# All VRAM addresses are offset by 0x8000
 		# Following addresses are 0x9800 and 0x9C00
 		background_offset = 0x1800 if lcd._LCDC.backgroundmap_select == 0 else 0x1C00
@@ -67,144 +259,204 @@ class Render:
 		# window is drawing something on the screen.
 		if lcd._LCDC.window_enable and wy <= y and wx < COLS:
 			self.ly_window += 1
-		for x in range(COLS):
-			if lcd._LCDC.window_enable and wy <= y and wx <= x:
-				# 计算GameBoy屏幕上窗口区域中当前像素(x, y)对应的tile在VRAM(tile map memory) 中的地址。
-				# 这个计算涉及了将屏幕坐标转换为窗口tile map中的tile索引。具体来说： 
-				# wmap：这是窗口VRAM tile map的起始地址，它可以是0x1800或0x1C00，取决于LCDC寄存器中的设置
-				# self.ly_window//8：根据窗口内部计数器ly_window(它表示从窗口顶部开始的行数)计算出的当前行号
-				#		由于一个tile为8x8像素，所以需要除以8来得到tile行号
-				# *32：每行有32个tile，因此，把上面得到的行号乘以32可以得到VRAM中对应的tile map行的起始地址
-				# %0x400：VRAM的tile map区域大小为0x400(1024 bytes)，取模确保地址不会超出VRAM tile map的范围
-				# (x-wx)//8：根据像素的屏幕横坐标以及窗口的横坐标(wx)计算所在tile的横坐标。由于每个tile为8 像素宽，
-				#		所以像素坐标减去窗口左边界的值后除以 8 得到 tile 列索引
-				# %32：与行的计算类似，确保列索引不会超出每行32个tile的范围
-				# 将这些组合在一起，tile_addr表示了VRAM中，当前像素所在tile的实际地址。这个地址接着可用于查找背景色
-				# 或图案以进行渲染。
-				tile_addr = wmap + (self.ly_window)//8*32%0x400 + (x-wx)//8%32
-				wt = lcd.VRAM0[tile_addr]
-				# If using signed tile indices, modify index
-				if not lcd._LCDC.tiledata_select:
-					# (x ^ 0x80 - 128) to convert to signed, then
-					# add 256 for offset (reduces to + 128)
-					wt = (wt ^ 0x80) + 128
-				bg_priority_apply = 0
-				if self.cgb:
-					palette, vbank, horiflip, vertflip, bg_priority = self._cgb_get_background_map_attributes(lcd, tile_addr)
-					if vbank:
-						self.update_tilecache1(lcd, wt, vbank)
-						tilecache = self._tilecache1
+		if not self.cgb:
+			self.scanline_tiles(lcd, y, background_offset, wmap, bx, by, wx, wy)
+		else:
+			# Pixel by pixel, with the CGB attributes of each tile
+			for x in range(COLS):
+				if lcd._LCDC.window_enable and wy <= y and wx <= x:
+					# 计算GameBoy屏幕上窗口区域中当前像素(x, y)对应的tile在VRAM(tile map memory) 中的地址。
+					# 这个计算涉及了将屏幕坐标转换为窗口tile map中的tile索引。具体来说： 
+					# wmap：这是窗口VRAM tile map的起始地址，它可以是0x1800或0x1C00，取决于LCDC寄存器中的设置
+					# self.ly_window//8：根据窗口内部计数器ly_window(它表示从窗口顶部开始的行数)计算出的当前行号
+					#		由于一个tile为8x8像素，所以需要除以8来得到tile行号
+					# *32：每行有32个tile，因此，把上面得到的行号乘以32可以得到VRAM中对应的tile map行的起始地址
+					# %0x400：VRAM的tile map区域大小为0x400(1024 bytes)，取模确保地址不会超出VRAM tile map的范围
+					# (x-wx)//8：根据像素的屏幕横坐标以及窗口的横坐标(wx)计算所在tile的横坐标。由于每个tile为8 像素宽，
+					#		所以像素坐标减去窗口左边界的值后除以 8 得到 tile 列索引
+					# %32：与行的计算类似，确保列索引不会超出每行32个tile的范围
+					# 将这些组合在一起，tile_addr表示了VRAM中，当前像素所在tile的实际地址。这个地址接着可用于查找背景色
+					# 或图案以进行渲染。
+					tile_addr = wmap + (self.ly_window)//8*32%0x400 + (x-wx)//8%32
+					wt = lcd.VRAM0[tile_addr]
+					# If using signed tile indices, modify index
+					if not lcd._LCDC.tiledata_select:
+						# (x ^ 0x80 - 128) to convert to signed, then
+						# add 256 for offset (reduces to + 128)
+						wt = (wt ^ 0x80) + 128
+					bg_priority_apply = 0
+					if self.cgb:
+						palette, vbank, horiflip, vertflip, bg_priority = self._cgb_get_background_map_attributes(lcd, tile_addr)
+						if vbank:
+							self.update_tilecache1(lcd, wt, vbank)
+							tilecache = self._tilecache1
+						else:
+							self.update_tilecache0(lcd, wt, vbank)
+							tilecache = self._tilecache0
+						xx = (7 - ((x-wx) % 8)) if horiflip else ((x-wx) % 8)
+						yy = (8*wt + (7 - (self.ly_window) % 8)) if vertflip else (8*wt + (self.ly_window) % 8)
+						pixel = cgbcolor(palette, tilecache[yy, xx])
+						col0 = (tilecache[yy, xx] == 0) & 1
+						if bg_priority:
+							# We hide extra rendering information in the lower 8 bits (A) of the 32-bit RGBA format
+							bg_priority_apply = BG_PRIORITY_FLAG
 					else:
-						self.update_tilecache0(lcd, wt, vbank)
-						tilecache = self._tilecache0
-					xx = (7 - ((x-wx) % 8)) if horiflip else ((x-wx) % 8)
-					yy = (8*wt + (7 - (self.ly_window) % 8)) if vertflip else (8*wt + (self.ly_window) % 8)
-					pixel = lcd.bcpd.getcolor(palette, tilecache[yy, xx])
-					col0 = (tilecache[yy, xx] == 0) & 1
-					if bg_priority:
-						# We hide extra rendering information in the lower 8 bits (A) of the 32-bit RGBA format
-						bg_priority_apply = BG_PRIORITY_FLAG
-				else:
-					self.update_tilecache0(lcd, wt, 0)
-					xx = (x-wx) % 8
-					yy = 8*wt + (self.ly_window) % 8
-					pixel = lcd.BGP.getcolor(self._tilecache0[yy, xx])
-					col0 = (self._tilecache0[yy, xx] == 0) & 1
-				self._screenbuffer[y, x] = pixel
-				# COL0_FLAG is 1
-				self._screenbuffer_attributes[y, x] = bg_priority_apply | col0
-			# background_enable doesn't exist for CGB. It works as master priority instead
-			elif (not self.cgb and lcd._LCDC.background_enable) or self.cgb:
-				tile_addr = background_offset + (y+by) // 8 * 32 % 0x400 + (x+bx) // 8 % 32
-				bt = lcd.VRAM0[tile_addr]
-				# If using signed tile indices, modify index
-				if not lcd._LCDC.tiledata_select:
-					# (x ^ 0x80 - 128) to convert to signed, then
-					# add 256 for offset (reduces to + 128)
-					bt = (bt ^ 0x80) + 128
-				bg_priority_apply = 0
-				if self.cgb:
-					palette, vbank, horiflip, vertflip, bg_priority = self._cgb_get_background_map_attributes(lcd, tile_addr)
-					if vbank:
-						self.update_tilecache1(lcd, bt, vbank)
-						tilecache = self._tilecache1
+						self.update_tilecache0(lcd, wt, 0)
+						xx = (x-wx) % 8
+						yy = 8*wt + (self.ly_window) % 8
+						pixel = bgcolor(self._tilecache0[yy, xx])
+						col0 = (self._tilecache0[yy, xx] == 0) & 1
+					buffer[y, x] = pixel
+					# COL0_FLAG is 1
+					self._screenbuffer_attributes[y, x] = bg_priority_apply | col0
+				# background_enable doesn't exist for CGB. It works as master priority instead
+				elif (not self.cgb and lcd._LCDC.background_enable) or self.cgb:
+					tile_addr = background_offset + (y+by) // 8 * 32 % 0x400 + (x+bx) // 8 % 32
+					bt = lcd.VRAM0[tile_addr]
+					# If using signed tile indices, modify index
+					if not lcd._LCDC.tiledata_select:
+						# (x ^ 0x80 - 128) to convert to signed, then
+						# add 256 for offset (reduces to + 128)
+						bt = (bt ^ 0x80) + 128
+					bg_priority_apply = 0
+					if self.cgb:
+						palette, vbank, horiflip, vertflip, bg_priority = self._cgb_get_background_map_attributes(lcd, tile_addr)
+						if vbank:
+							self.update_tilecache1(lcd, bt, vbank)
+							tilecache = self._tilecache1
+						else:
+							self.update_tilecache0(lcd, bt, vbank)
+							tilecache = self._tilecache0
+						xx = (7 - ((x+offset) % 8)) if horiflip else ((x+offset) % 8)
+						yy = (8*bt + (7 - (y+by) % 8)) if vertflip else (8*bt + (y+by) % 8)
+						pixel = cgbcolor(palette, tilecache[yy, xx])
+						col0 = (tilecache[yy, xx] == 0) & 1
+						if bg_priority:
+							# We hide extra rendering information in the lower 8 bits (A) of the 32-bit RGBA format
+							bg_priority_apply = BG_PRIORITY_FLAG
 					else:
-						self.update_tilecache0(lcd, bt, vbank)
-						tilecache = self._tilecache0
-					xx = (7 - ((x+offset) % 8)) if horiflip else ((x+offset) % 8)
-					yy = (8*bt + (7 - (y+by) % 8)) if vertflip else (8*bt + (y+by) % 8)
-					pixel = lcd.bcpd.getcolor(palette, tilecache[yy, xx])
-					col0 = (tilecache[yy, xx] == 0) & 1
-					if bg_priority:
-						# We hide extra rendering information in the lower 8 bits (A) of the 32-bit RGBA format
-						bg_priority_apply = BG_PRIORITY_FLAG
+						self.update_tilecache0(lcd, bt, 0)
+						xx = (x+offset) % 8
+						yy = 8*bt + (y+by) % 8
+						pixel = bgcolor(self._tilecache0[yy, xx])
+						col0 = (self._tilecache0[yy, xx] == 0) & 1
+					buffer[y, x] = pixel
+					self._screenbuffer_attributes[y, x] = bg_priority_apply|col0
 				else:
-					self.update_tilecache0(lcd, bt, 0)
-					xx = (x+offset) % 8
-					yy = 8*bt + (y+by) % 8
-					pixel = lcd.BGP.getcolor(self._tilecache0[yy, xx])
-					col0 = (self._tilecache0[yy, xx] == 0) & 1
-				self._screenbuffer[y, x] = pixel
-				self._screenbuffer_attributes[y, x] = bg_priority_apply|col0
-			else:
-				# If background is disabled, it becomes white
-				self._screenbuffer[y, x] = lcd.BGP.getcolor(0)
-				self._screenbuffer_attributes[y, x] = 0
+					# If background is disabled, it becomes white
+					buffer[y, x] = bgcolor(0)
+					self._screenbuffer_attributes[y, x] = 0
 		if y == 143:
 			# Reset at the end of a frame. We set it to -1, so it will be 0 after the first increment
 			self.ly_window = -1
 
-	def sort_sprites(self, sprite_count):
-		# Use insertion sort, as it has O(n) on already sorted arrays. This
-		# functions is likely called multiple times with unchanged data.
-		# Sort descending because of the sprite priority.
-		for i in range(1, sprite_count):
-			key = self.sprites_to_render[i] # The current element to be inserted into the sorted portion
-			j = i - 1 # Index of the last element in the sorted portion of the array
-			# Move elements of the sorted portion greater than the key to the right
-			while j >= 0 and key > self.sprites_to_render[j]:
-				self.sprites_to_render[j + 1] = self.sprites_to_render[j]
-				j -= 1
-			# Insert the key into its correct position in the sorted portion
-			self.sprites_to_render[j + 1] = key
+	def skip_line(self, lcd, y):
+		# Keeps the window line counter going for a line which isn't drawn again, see PPU.draw_line
+		wx, wy = lcd.getwindowpos()
+		if lcd._LCDC.window_enable and wy <= y and wx < COLS:
+			self.ly_window += 1
+		if y == 143:
+			self.ly_window = -1
 
-	def scanline_sprites(self, lcd, ly, buffer, buffer_attributes, ignore_priority):
-		if not lcd._LCDC.sprite_enable or lcd.disable_renderer:
-			return
-		# Find the first 10 sprites in OAM that appears on this scanline.
-		# The lowest X-coordinate has priority, when overlapping
-		spriteheight = 16 if lcd._LCDC.sprite_height else 8
-		sprite_count = 0
+	def layer(self, base, signed):
+		layer = self._layers.get((base, signed))
+		if layer is None:
+			layer = self._layers[(base, signed)] = TileLayer(base, signed)
+		return layer
+
+	def scanline_tiles(self, lcd, y, background_offset, wmap, bx, by, wx, wy):
+		# DMG background and window, cut from the layers of the tile maps as color codes, and colored for the whole line
+		# at once
+		if self._dirty_tiles:
+			for layer in self._layers.values():
+				layer.invalidate_tiles(self._dirty_tiles)
+			self._dirty_tiles.clear()
+		vram = lcd.VRAM0
+		signed = not lcd._LCDC.tiledata_select
+		window = lcd._LCDC.window_enable and wy <= y and wx < COLS
+		start = max(wx, 0) if window else COLS
+		if start == 0:
+			codes = attributes = b""
+		elif lcd._LCDC.background_enable:
+			layer = self.layer(background_offset, signed)
+			row = layer.row(vram, (y+by) & 0xFF)
+			if bx + start <= 256:
+				codes = layer.codes[row + bx:row + bx + start]
+			else:
+				# Wraps around the right edge of the map
+				codes = layer.codes[row + bx:row + 256] + layer.codes[row:row + bx + start - 256]
+			attributes = codes.translate(COL0_TABLE)
+		else:
+			# If background is disabled, it becomes white
+			codes = attributes = bytes(start)
+		if start < COLS:
+			layer = self.layer(wmap, signed)
+			row = layer.row(vram, self.ly_window & 0xFF)
+			window_codes = layer.codes[row + start - wx:row + COLS - wx]
+			codes += window_codes
+			attributes += window_codes.translate(COL0_TABLE)
+		line = y * COLS
+		self._screenbuffer_attributes_bytes[line:line + COLS] = attributes
+		palette = (lcd.BGP.value, self.index_mode)
+		if palette != self._line_palette:
+			self._line_palette = palette
+			if self.index_mode:
+				self._line_tables = [bytes(lcd.BGP.lookup) + bytes(252)]
+			else:
+				colors = [lcd.BGP.getcolor(c) for c in range(4)]
+				self._line_tables = [bytes([(color >> (8 * n)) & 0xFF for color in colors]) + bytes(252) for n in range(4)]
+		if self.index_mode:
+			self._indexbuffer_bytes[line:line + COLS] = codes.translate(self._line_tables[0])
+		else:
+			# One translation per byte of the 32-bit pixels
+			for n in range(4):
+				self._screenbuffer_bytes[line * 4 + n:(line + COLS) * 4:4] = codes.translate(self._line_tables[n])
+
+	def sprite_lines(self, lcd, spriteheight):
+		# The sprites of each line in drawing order, as (y, x, tile, attributes). Rebuilt only when OAM or the sprite
+		# height differs from the last time, which is checked with one comparison of the whole OAM.
+		if spriteheight == self._sprite_height and self._sprite_oam == memoryview(lcd.OAM):
+			return self._sprite_lines
+		oam = bytes(lcd.OAM)
+		lines = [[] for _ in range(ROWS)]
+		# Find the first 10 sprites in OAM that appear on each line
 		for n in range(0x00, 0xA0, 4):
-			y = lcd.OAM[n] - 16 # Documentation states the y coordinate needs to be subtracted by 16
-			x = lcd.OAM[n + 1] - 8 # Documentation states the x coordinate needs to be subtracted by 8
-			if y <= ly < y + spriteheight:
-				# x is used for sorting for priority
-				if self.cgb:
-					self.sprites_to_render[sprite_count] = n
-				else:
-					self.sprites_to_render[sprite_count] = x << 16 | n
-				sprite_count += 1
-			if sprite_count == 10:
-				break
+			y = oam[n] - 16 # Documentation states the y coordinate needs to be subtracted by 16
+			x = oam[n + 1] - 8 # Documentation states the x coordinate needs to be subtracted by 8
+			tileindex = oam[n + 2]
+			if spriteheight == 16:
+				tileindex &= 0b11111110
+			# x is used for sorting for priority
+			sprite = (n if self.cgb else x << 16 | n, (y, x, tileindex, oam[n + 3]))
+			for ly in range(max(y, 0), min(y + spriteheight, ROWS)):
+				if len(lines[ly]) < 10:
+					lines[ly].append(sprite)
 		# Pan docs:
 		# When these 10 sprites overlap, the highest priority one will appear above all others, etc. (Thus, no
 		# Z-fighting.) In CGB mode, the first sprite in OAM ($FE00-$FE03) has the highest priority, and so on. In
 		# Non-CGB mode, the smaller the X coordinate, the higher the priority. The tie breaker (same X coordinates) is
 		# the same priority as in CGB mode.
-		self.sort_sprites(sprite_count)
-		for _n in self.sprites_to_render[:sprite_count]:
+		# They are drawn with the highest priority last, so it ends up on top.
+		self._sprite_lines = [tuple(sprite for key, sprite in sorted(line, reverse=True)) for line in lines]
+		self._sprite_oam = oam
+		self._sprite_height = spriteheight
+		return self._sprite_lines
+
+	def scanline_sprites(self, lcd, ly, buffer, buffer_attributes, ignore_priority):
+		if not lcd._LCDC.sprite_enable or lcd.disable_renderer:
+			return
+		spriteheight = 16 if lcd._LCDC.sprite_height else 8
+		if self.index_mode:
+			obp0color = lcd.OBP0.lookup.__getitem__
+			obp1color = lcd.OBP1.lookup.__getitem__
 			if self.cgb:
-				n = _n
-			else:
-				n = _n & 0xFF
-			# n = self.sprites_to_render_n[_n]
-			y = lcd.OAM[n] - 16 # Documentation states the y coordinate needs to be subtracted by 16
-			x = lcd.OAM[n + 1] - 8 # Documentation states the x coordinate needs to be subtracted by 8
-			tileindex = lcd.OAM[n + 2]
-			if spriteheight == 16:
-				tileindex &= 0b11111110
-			attributes = lcd.OAM[n + 3]
+				cgbcolor = self._cgb_sprite_color_index
+		else:
+			obp0color = lcd.OBP0.getcolor
+			obp1color = lcd.OBP1.getcolor
+			if self.cgb:
+				cgbcolor = lcd.ocpd.getcolor
+		for y, x, tileindex, attributes in self.sprite_lines(lcd, spriteheight)[ly]:
 			xflip = attributes & 0b00100000
 			yflip = attributes & 0b01000000
 			spritepriority = (attributes & 0b10000000) and not ignore_priority
@@ -240,7 +492,7 @@ class Render:
 				color_code = spritecache[8*tileindex + yy, xx]
 				if 0 <= x < COLS and not color_code == 0: # If pixel is not transparent
 					if self.cgb:
-						pixel = lcd.ocpd.getcolor(palette, color_code)
+						pixel = cgbcolor(palette, color_code)
 						bgmappriority = buffer_attributes[ly, x] & BG_PRIORITY_FLAG
 
 						if lcd._LCDC.cgb_master_priority: # If 0, sprites are always on top, if 1 follow priorities
@@ -257,9 +509,9 @@ class Render:
 					else:
 						# TODO: Unify with CGB
 						if attributes & 0b10000:
-							pixel = lcd.OBP1.getcolor(color_code)
+							pixel = obp1color(color_code)
 						else:
-							pixel = lcd.OBP0.getcolor(color_code)
+							pixel = obp0color(color_code)
 
 						if spritepriority: # If 1, sprite is behind bg/window. Color 0 of window/bg is transparent
 							if buffer_attributes[ly, x] & COL0_FLAG: # if BG pixel is transparent
@@ -273,6 +525,8 @@ class Render:
 		self.clear_tilecache0()
 		self.clear_spritecache0()
 		self.clear_spritecache1()
+		self._layers.clear()
+		self._dirty_tiles.clear()
 
 	def invalidate_tile(self, tile, vbank):
 		if vbank and self.cgb:
@@ -286,6 +540,12 @@ class Render:
 				self._tilecache1_state[tile] = 0
 			self._spritecache0_state[tile] = 0
 			self._spritecache1_state[tile] = 0
+			self._dirty_tiles.add(tile)
+
+	def invalidate_tiles(self, first, last, vbank):
+		# Same as `invalidate_tile` for the tiles first..last-1, e.g. after a DMA transfer
+		for tile in range(first, last):
+			self.invalidate_tile(tile, vbank)
 
 	def clear_tilecache0(self):
 		for i in range(TILES):
@@ -302,28 +562,17 @@ class Render:
 		for i in range(TILES):
 			self._spritecache1_state[i] = 0
 
-	def color_code(self, byte1, byte2, offset):
-		"""Convert 2 bytes into color code at a given offset.
-		The colors are 2 bit and are found like this:
-		Color of the first pixel is 0b10
-		| Color of the second pixel is 0b01
-		v v
-		1 0 0 1 0 0 0 1 <- byte1
-		0 1 1 1 1 1 0 0 <- byte2
-		"""
-		return (((byte2 >> (offset)) & 0b1) << 1) + ((byte1 >> (offset)) & 0b1)
+	def decode_tile(self, vram, t, cache_raw):
+		# Decodes the 8 rows of tile t into its 64 bytes of the cache, one table slice per row
+		for k in range(0, 16, 2): # 2 bytes for each line
+			key = (vram[t*16 + k] | vram[t*16 + k + 1] << 8) * 8
+			y = (t*16 + k) * 4
+			cache_raw[y:y + 8] = TILE_ROW_TABLE[key:key + 8]
 
 	def update_tilecache0(self, lcd, t, bank):
 		if self._tilecache0_state[t]:
 			return
-		# for t in self.tiles_changed0:
-		for k in range(0, 16, 2): # 2 bytes for each line
-			byte1 = lcd.VRAM0[t*16 + k]
-			byte2 = lcd.VRAM0[t*16 + k + 1]
-			y = (t*16 + k) // 2
-			for x in range(8):
-				colorcode = self.color_code(byte1, byte2, 7 - x)
-				self._tilecache0[y, x] = colorcode
+		self.decode_tile(lcd.VRAM0, t, self._tilecache0_raw)
 		self._tilecache0_state[t] = 1
 
 	def update_tilecache1(self, lcd, t, bank):
@@ -332,35 +581,21 @@ class Render:
 	def update_spritecache0(self, lcd, t, bank):
 		if self._spritecache0_state[t]:
 			return
-		# for t in self.tiles_changed0:
-		for k in range(0, 16, 2): # 2 bytes for each line
-			byte1 = lcd.VRAM0[t*16 + k]
-			byte2 = lcd.VRAM0[t*16 + k + 1]
-			y = (t*16 + k) // 2
-
-			for x in range(8):
-				colorcode = self.color_code(byte1, byte2, 7 - x)
-				self._spritecache0[y, x] = colorcode
-
+		self.decode_tile(lcd.VRAM0, t, self._spritecache0_raw)
 		self._spritecache0_state[t] = 1
 
 	def update_spritecache1(self, lcd, t, bank):
 		if self._spritecache1_state[t]:
 			return
-		# for t in self.tiles_changed0:
-		for k in range(0, 16, 2): # 2 bytes for each line
-			byte1 = lcd.VRAM0[t*16 + k]
-			byte2 = lcd.VRAM0[t*16 + k + 1]
-			y = (t*16 + k) // 2
-
-			for x in range(8):
-				colorcode = self.color_code(byte1, byte2, 7 - x)
-				self._spritecache1[y, x] = colorcode
-
+		self.decode_tile(lcd.VRAM0, t, self._spritecache1_raw)
 		self._spritecache1_state[t] = 1
 
 	def blank_screen(self, lcd):
 		# If the screen is off, fill it with a color.
+		if self.index_mode:
+			self._indexbuffer_raw[:] = array.array("B", [lcd.BGP.lookup[0]]) * (ROWS*COLS)
+			self._screenbuffer_attributes_raw[:] = array.array("B", bytes(ROWS*COLS))
+			return
 		for y in range(ROWS):
 			for x in range(COLS):
 				self._screenbuffer[y, x] = lcd.BGP.getcolor(0)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import numpy as np
+
+from .render import *
+
+# NumPy渲染器
+class VectorizedRender:
+	"""Draws whole scanlines of a Render with NumPy gathers, instead of one pixel at a time.
+
+	It uses the buffers, tile cache and window line counter of the Render, so the two can be swapped at any time (see
+	Render.set_vectorized) and give the same pixels. Only DMG is handled, CGB lines are passed on to the Render.
+	"""
+	def __init__(self, render):
+		self.render = render
+		self.columns = np.arange(COLS)
+		self.pixels = np.arange(8)
+		self.tilecache = np.frombuffer(render._tilecache0_raw, dtype=np.uint8)
+		self.tilecache_state = np.frombuffer(render._tilecache0_state, dtype=np.uint8)
+		self.screen = np.frombuffer(render._screenbuffer_raw, dtype=np.uint32).reshape(ROWS, COLS)
+		self.indices = np.frombuffer(render._indexbuffer_raw, dtype=np.uint8).reshape(ROWS, COLS)
+		self.attributes = np.frombuffer(render._screenbuffer_attributes_raw, dtype=np.uint8).reshape(ROWS, COLS)
+		self.lcd = None
+		self.palettes = {} # Colors of each palette register, by register, value and output mode
+
+	def __attach(self, lcd):
+		# Views of the PPU memory, which is only ever updated in place
+		self.lcd = lcd
+		self.vram = np.frombuffer(lcd.VRAM0, dtype=np.uint8)
+		self.oam = np.frombuffer(lcd.OAM, dtype=np.uint8)
+
+	def __colors(self, palette):
+		key = (id(palette), palette.value, self.render.index_mode)
+		colors = self.palettes.get(key)
+		if colors is None:
+			if self.render.index_mode:
+				colors = np.array(palette.lookup, dtype=np.uint8)
+			else:
+				colors = np.array([palette.getcolor(i) for i in range(4)], dtype=np.uint32)
+			self.palettes[key] = colors
+		return colors
+
+	def __output(self, buffer):
+		if buffer is self.render._outputbuffer:
+			return self.indices if self.render.index_mode else self.screen
+		return np.asarray(buffer)
+
+	def __decode(self, lcd, tiles):
+		# Makes sure the tiles are in the tile cache
+		missing = tiles[self.tilecache_state[tiles] == 0]
+		for t in np.unique(missing):
+			self.render.update_tilecache0(lcd, int(t), 0)
+
+	def __tile_row(self, lcd, tilemap, row, xs):
+		# Color codes of the map row `row` (0-255) at the map columns `xs`
+		tiles = self.vram[tilemap + (row // 8 * 32 % 0x400) + ((xs >> 3) & 31)].astype(np.intp)
+		if not lcd._LCDC.tiledata_select:
+			# Signed tile indices, see Render.scanline
+			tiles = (tiles ^ 0x80) + 128
+		self.__decode(lcd, tiles)
+		return self.tilecache[(tiles * 8 + row % 8) * 8 + (xs & 7)]
+
+	def scanline(self, lcd, y):
+		render = self.render
+		if render.cgb:
+			return Render.scanline(render, lcd, y)
+		bx, by = lcd.getviewport()	# (SCX, SCY)
+		wx, wy = lcd.getwindowpos()	# (WX-7, WY)
+		parameters = render._scanlineparameters[y]
+		parameters[0] = bx
+		parameters[1] = by
+		parameters[2] = wx
+		parameters[3] = wy
+		parameters[4] = lcd._LCDC.tiledata_select
+		if lcd.disable_renderer:
+			return
+		if lcd is not self.lcd:
+			self.__attach(lcd)
+		lcdc = lcd._LCDC
+		line = self.indices[y] if render.index_mode else self.screen[y]
+		attributes = self.attributes[y]
+		colors = self.__colors(lcd.BGP)
+		window = lcdc.window_enable and wy <= y and wx < COLS
+		if window:
+			render.ly_window += 1
+			start = max(wx, 0)
+		else:
+			start = COLS
+		# Background left of the window
+		if start > 0:
+			if lcdc.background_enable:
+				background_offset = 0x1800 if lcdc.backgroundmap_select == 0 else 0x1C00
+				codes = self.__tile_row(lcd, background_offset, (y + by) & 0xFF, self.columns[:start] + bx)
+				line[:start] = colors[codes]
+				attributes[:start] = codes == 0 # COL0_FLAG
+			else:
+				# If background is disabled, it becomes white
+				line[:start] = colors[0]
+				attributes[:start] = 0
+		if start < COLS:
+			wmap = 0x1800 if lcdc.windowmap_select == 0 else 0x1C00
+			codes = self.__tile_row(lcd, wmap, render.ly_window, self.columns[start:] - wx)
+			line[start:] = colors[codes]
+			attributes[start:] = codes == 0
+		if y == 143:
+			# Reset at the end of a frame. We set it to -1, so it will be 0 after the first increment
+			render.ly_window = -1
+
+	def scanline_sprites(self, lcd, ly, buffer, buffer_attributes, ignore_priority):
+		render = self.render
+		if render.cgb:
+			return Render.scanline_sprites(render, lcd, ly, buffer, buffer_attributes, ignore_priority)
+		if not lcd._LCDC.sprite_enable or lcd.disable_renderer:
+			return
+		if lcd is not self.lcd:
+			self.__attach(lcd)
+		spriteheight = 16 if lcd._LCDC.sprite_height else 8
+		# The first 10 sprites in OAM on this line
+		dy = ly + 16 - self.oam[0::4].astype(np.intp)
+		n = np.flatnonzero((dy >= 0) & (dy < spriteheight))[:10]
+		if len(n) == 0:
+			return
+		dy = dy[n]
+		n = n * 4
+		x = self.oam[n + 1].astype(np.intp) - 8
+		# Highest priority first: the smallest X, then the first in OAM. Render.scanline_sprites draws them the other
+		# way round, so the highest priority ends up on top.
+		order = np.argsort(x << 16 | n)
+		n, x, dy = n[order], x[order], dy[order]
+		tiles = self.oam[n + 2].astype(np.intp)
+		attributes = self.oam[n + 3]
+		if spriteheight == 16:
+			tiles &= 0b11111110
+			self.__decode(lcd, np.concatenate((tiles, tiles + 1)))
+		else:
+			self.__decode(lcd, tiles)
+		yy = np.where(attributes & 0b01000000, spriteheight - dy - 1, dy)
+		xx = np.where((attributes & 0b00100000)[:, None], 7 - self.pixels, self.pixels)
+		codes = self.tilecache[((8 * tiles + yy) * 8)[:, None] + xx]
+		xs = x[:, None] + self.pixels
+		visible = (codes != 0) & (xs >= 0) & (xs < COLS)
+		if buffer_attributes is render._screenbuffer_attributes:
+			bg_attributes = self.attributes[ly]
+		else:
+			bg_attributes = np.asarray(buffer_attributes)[ly]
+		if not ignore_priority:
+			# Behind the background, except where it has color 0
+			behind = (attributes & 0b10000000) != 0
+			visible &= ~behind[:, None] | (bg_attributes[np.clip(xs, 0, COLS - 1)] & COL0_FLAG != 0)
+		palettes = np.stack((self.__colors(lcd.OBP0), self.__colors(lcd.OBP1)))
+		pixels = palettes[((attributes >> 4) & 1)[:, None], codes]
+		# Where the sprites overlap, the first visible pixel in priority order wins
+		xs = xs[visible]
+		pixels = pixels[visible]
+		xs, first = np.unique(xs, return_index=True)
+		self.__output(buffer)[ly, xs] = pixels[first]
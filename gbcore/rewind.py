@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import collections
+import io
+import re
+import struct
+
+# Short gaps of unchanged bytes are cheaper to keep inside a run than to start a new one
+CHANGED_RUNS = re.compile(rb"[^\x00]+(?:\x00{1,8}[^\x00]+)*")
+RUN_HEADER = struct.Struct("<II") # Position and length of a run
+
+def xor(a, b):
+	return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def encode(delta):
+	# Run-length encoding of an XOR delta, keeping only the runs of changed bytes
+	out = []
+	for m in CHANGED_RUNS.finditer(delta):
+		out.append(RUN_HEADER.pack(m.start(), m.end() - m.start()))
+		out.append(m.group())
+	return b"".join(out)
+
+def apply(state, record):
+	# XORs an encoded delta into the bytearray `state`
+	pos = 0
+	while pos < len(record):
+		start, length = RUN_HEADER.unpack_from(record, pos)
+		pos += RUN_HEADER.size
+		state[start:start + length] = xor(state[start:start + length], record[pos:pos + length])
+		pos += length
+
+# 倒带
+class RewindBuffer:
+	"""Keeps the last frames of the machine in a fixed-size ring buffer, so the emulation can be stepped backwards.
+
+	Every `keyframe_interval` frames the whole save state is stored, and in between only the XOR delta against the
+	state of the previous frame. Both are run-length encoded. When the ring is full, the oldest frames are dropped
+	together with the deltas depending on them.
+	"""
+	def __init__(self, mb, keyframe_interval=60, buffer_size=8 * 1024 * 1024):
+		self.mb = mb
+		self.keyframe_interval = keyframe_interval
+		self.buffer = bytearray(buffer_size)
+		self.head = 0 # Where the next record is written
+		self.entries = collections.deque() # Offset, length and keyframe flag of each frame, oldest first
+		self.previous = None # State of the last captured frame
+		self.since_keyframe = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def clear(self):
+		self.head = 0
+		self.entries.clear()
+		self.previous = None
+		self.since_keyframe = 0
+
+	def capture(self):
+		# Called when a frame is done
+		f = io.BytesIO()
+		self.mb.save_state(f, False)
+		state = f.getvalue()
+		keyframe = self.previous is None or self.since_keyframe >= self.keyframe_interval or \
+			len(state) != len(self.previous)
+		if keyframe:
+			record = encode(state)
+			self.since_keyframe = 0
+		else:
+			record = encode(xor(state, self.previous))
+		self.since_keyframe += 1
+		self.previous = state
+		if not self.__store(record, keyframe):
+			# The frames this delta depends on were all dropped. Store the frame as a keyframe instead.
+			self.since_keyframe = 1
+			self.__store(encode(state), True)
+
+	def __store(self, record, keyframe):
+		# Returns False if a delta couldn't be stored, because no keyframe is left before it
+		length = len(record)
+		if length > len(self.buffer):
+			# Doesn't fit at all. Start over from the next keyframe.
+			self.clear()
+			return True
+		offset = self.head
+		if offset + length > len(self.buffer):
+			offset = 0
+		# Drop the oldest frames, which are overwritten by this one
+		end = offset + length
+		while self.entries:
+			start = self.entries[0][0]
+			if (self.head <= start < len(self.buffer) and offset == 0 and self.head != 0) or offset <= start < end:
+				self.entries.popleft()
+			else:
+				break
+		# Deltas can't be restored without the keyframe before them
+		while self.entries and not self.entries[0][2]:
+			self.entries.popleft()
+		if not self.entries and not keyframe:
+			return False
+		self.buffer[offset:end] = record
+		self.entries.append((offset, length, keyframe))
+		self.head = end
+		return True
+
+	def rewind(self, frames=1):
+		# Restores the state from `frames` frames before the last captured one, and forgets the frames after it.
+		# Returns the number of frames which were actually rewound.
+		if not self.entries:
+			return 0
+		frames = min(frames, len(self.entries) - 1)
+		# Find the keyframe and replay the deltas after it
+		index = len(self.entries) - 1 - frames
+		while index >= 0 and not self.entries[index][2]:
+			index -= 1
+		if index < 0:
+			return 0
+		for _ in range(frames):
+			self.entries.pop()
+		view = memoryview(self.buffer)
+		state = bytearray(len(self.previous))
+		for n in range(index, len(self.entries)):
+			offset, length, keyframe = self.entries[n]
+			apply(state, view[offset:offset + length])
+		self.mb.load_state(io.BytesIO(state))
+		offset, length, keyframe = self.entries[-1]
+		self.head = offset + length
+		self.previous = bytes(state)
+		self.since_keyframe = len(self.entries) - index
+		return frames
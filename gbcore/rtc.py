@@ -5,6 +5,9 @@ import struct
 import time
 import os
 
+# latch_enabled, timezero, sec_latch, min_latch, hour_latch, day_latch_low, day_latch_high, day_carry, halt
+RTC_STATE = struct.Struct("<?d7B")
+
 class RTC:
 	def __init__(self):
 		self.latch_enabled = False
@@ -20,6 +23,14 @@ class RTC:
 	def stop(self):
 		pass 
 
+	def save_state(self, f):
+		f.write(RTC_STATE.pack(self.latch_enabled, self.timezero, self.sec_latch, self.min_latch, self.hour_latch,
+			self.day_latch_low, self.day_latch_high, self.day_carry, self.halt))
+
+	def load_state(self, f, state_version):
+		(self.latch_enabled, self.timezero, self.sec_latch, self.min_latch, self.hour_latch, self.day_latch_low,
+			self.day_latch_high, self.day_carry, self.halt) = RTC_STATE.unpack(f.read(RTC_STATE.size))
+
 	def latch_rtc(self):
 		t = time.time() - self.timezero
 		self.sec_latch = int(t % 60)
@@ -7,22 +7,42 @@
 # http://gbdev.gg8.se/wiki/articles/Gameboy_sound_hardware
 # http://www.devrs.com/gb/files/hosted/GBSOUND.txt
 import logging as logger
+import struct
 from array import array
 from ctypes import c_void_p
 
-try:
-    import sdl2
-except ImportError:
-    sdl2 = None
+sdl2 = None # Only imported when sound output is enabled, so headless runs never load SDL
+
+
+def load_sdl2():
+    global sdl2
+    try:
+        import sdl2
+    except ImportError:
+        sdl2 = None
+    return sdl2 is not None
 
 
 SOUND_DESYNC_THRESHOLD = 5
 CPU_FREQ = 4213440 # hz
+# clock, poweron, leftnoise, leftwave, lefttone, leftsweep, rightnoise, rightwave, righttone, rightsweep
+SOUND_STATE = struct.Struct("<i9?")
+
+
+def save_fields(obj, file):
+    # Register and internal values of a channel, as listed in its STATE_FIELDS
+    file.write(struct.pack("<%di" % len(obj.STATE_FIELDS), *[getattr(obj, name) for name in obj.STATE_FIELDS]))
+
+
+def load_fields(obj, file):
+    values = struct.unpack("<%di" % len(obj.STATE_FIELDS), file.read(4 * len(obj.STATE_FIELDS)))
+    for name, value in zip(obj.STATE_FIELDS, values):
+        setattr(obj, name, value)
 
 
 class Sound:
     def __init__(self, enabled, emulate):
-        self.enabled = enabled and (sdl2 is not None)
+        self.enabled = enabled and load_sdl2()
         self.emulate = emulate or enabled # Just emulate registers etc.
         if self.enabled:
             # Initialization is handled in the windows, otherwise we'd need this
@@ -51,8 +71,10 @@ class Sound:
             self.sample_rate = 32768
             self.sampleclocks = CPU_FREQ // self.sample_rate
 
-        self.audiobuffer = array("b", [0] * 4096) # Over 2 frames
+        self.audiobuffer = array("b", bytes(4096)) # Over 2 frames
         self.audiobuffer_p = c_void_p(self.audiobuffer.buffer_info()[0])
+        # Without an audio device the samples are appended, until the owner reads them and resets the head
+        self.audiobuffer_head = 0
 
         self.clock = 0
 
@@ -151,8 +173,10 @@ class Sound:
             return
 
         nsamples = self.clock // self.sampleclocks
+        head = self.audiobuffer_head
+        count = min(2048 - head, nsamples)
 
-        for i in range(min(2048, nsamples)):
+        for i in range(head, head + count):
             if self.poweron:
                 self.sweepchannel.run(self.sampleclocks)
                 self.tonechannel.run(self.sampleclocks)
@@ -175,6 +199,8 @@ class Sound:
 
         if self.enabled:
             self.enqueue_sound(nsamples)
+        else:
+            self.audiobuffer_head += count
         self.clock %= self.sampleclocks
 
     def enqueue_sound(self, nsamples):
@@ -191,14 +217,29 @@ class Sound:
             sdl2.SDL_CloseAudioDevice(self.device)
 
     def save_state(self, file):
-        pass
+        file.write(SOUND_STATE.pack(self.clock, self.poweron, self.leftnoise, self.leftwave, self.lefttone,
+                                    self.leftsweep, self.rightnoise, self.rightwave, self.righttone, self.rightsweep))
+        save_fields(self.sweepchannel, file)
+        save_fields(self.tonechannel, file)
+        save_fields(self.wavechannel, file)
+        file.write(self.wavechannel.wavetable)
+        save_fields(self.noisechannel, file)
 
     def load_state(self, file, state_version):
-        pass
+        (self.clock, self.poweron, self.leftnoise, self.leftwave, self.lefttone, self.leftsweep, self.rightnoise,
+         self.rightwave, self.righttone, self.rightsweep) = SOUND_STATE.unpack(file.read(SOUND_STATE.size))
+        load_fields(self.sweepchannel, file)
+        load_fields(self.tonechannel, file)
+        load_fields(self.wavechannel, file)
+        file.readinto(self.wavechannel.wavetable)
+        load_fields(self.noisechannel, file)
 
 
 class ToneChannel:
     """Second sound channel--simple square wave, no sweep"""
+    STATE_FIELDS = ("wavsel", "sndlen", "envini", "envdir", "envper", "sndper", "uselen", "enable", "lengthtimer",
+                    "periodtimer", "envelopetimer", "period", "waveframe", "frametimer", "frame", "volume")
+
     def __init__(self):
         # Shape of square waves at different duty cycles
         # These could ostensibly be replaced with other waves for fun experiments
@@ -325,6 +366,8 @@ class ToneChannel:
 
 
 class SweepChannel(ToneChannel):
+    STATE_FIELDS = ToneChannel.STATE_FIELDS + ("swpper", "swpdir", "swpmag", "sweeptimer", "sweepenable", "shadow")
+
     def __init__(self):
         ToneChannel.__init__(self)
 
@@ -387,6 +430,9 @@ class SweepChannel(ToneChannel):
 
 class WaveChannel:
     """Third sound channel--sample-based playback"""
+    STATE_FIELDS = ("dacpow", "sndlen", "volreg", "sndper", "uselen", "enable", "lengthtimer", "periodtimer", "period",
+                    "waveframe", "frametimer", "frame", "volumeshift")
+
     def __init__(self):
         # Memory for wave sample
         self.wavetable = array("B", [0xFF] * 16)
@@ -498,6 +544,10 @@ class WaveChannel:
 
 class NoiseChannel:
     """Fourth sound channel--white noise generator"""
+    STATE_FIELDS = ("sndlen", "envini", "envdir", "envper", "clkpow", "regwid", "clkdiv", "uselen", "enable",
+                    "lengthtimer", "periodtimer", "envelopetimer", "period", "shiftregister", "lfsrfeed", "frametimer",
+                    "frame", "volume")
+
     def __init__(self):
         self.DIVTABLE = (8, 16, 32, 48, 64, 80, 96, 112)
 
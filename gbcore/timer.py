@@ -13,6 +13,10 @@
 # 01: 262144 Hz (OSC/16)
 # 10:  65536 Hz (OSC/64)
 # 11:  16384 Hz (OSC/256)
+import struct
+
+# DIV, TIMA, DIV_counter, TIMA_counter, TMA, TAC
+TIMER_STATE = struct.Struct("<2B2I2B")
 
 class Timer:
 	def __init__(self):
@@ -40,14 +44,15 @@ class Timer:
 			return False
 		self.TIMA_counter += cycles
 		divider = self.dividers[self.TAC & 0b11]
-		if self.TIMA_counter >= divider:
+		overflow = False
+		while self.TIMA_counter >= divider:
 			self.TIMA_counter -= divider # Keeps possible remainder
 			self.TIMA += 1
 			if self.TIMA > 0xFF:
 				self.TIMA = self.TMA
 				self.TIMA &= 0xFF
-				return True
-		return False
+				overflow = True
+		return overflow
 
 	def cycles_to_interrupt(self):
 		if self.TAC & 0b100 == 0: # Check if timer is not enabled
@@ -57,3 +62,9 @@ class Timer:
 		cyclesleft = ((0x100 - self.TIMA) * divider) - self.TIMA_counter
 		return cyclesleft
 
+	def save_state(self, f):
+		f.write(TIMER_STATE.pack(self.DIV, self.TIMA, self.DIV_counter, self.TIMA_counter, self.TMA, self.TAC))
+
+	def load_state(self, f, state_version):
+		self.DIV, self.TIMA, self.DIV_counter, self.TIMA_counter, self.TMA, self.TAC = \
+			TIMER_STATE.unpack(f.read(TIMER_STATE.size))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import ctypes
+import time
+
+# import PySDL2
+from sdl2 import *
+
+from .parameters import *
+
+# 键盘映射
+KEYMAP = {
+	SDLK_RIGHT: "right",
+	SDLK_LEFT: "left",
+	SDLK_UP: "up",
+	SDLK_DOWN: "down",
+	SDLK_a: "a",
+	SDLK_b: "b",
+	SDLK_BACKSPACE: "select",
+	SDLK_RETURN: "start",
+}
+
+# SDL窗口
+class Window:
+	def __init__(self, scale):
+		# 初始化SDL
+		SDL_Init(SDL_INIT_VIDEO|SDL_INIT_GAMECONTROLLER)
+		self._ftime = time.perf_counter_ns()
+		self._window = SDL_CreateWindow(b"PixelBoy", SDL_WINDOWPOS_CENTERED, SDL_WINDOWPOS_CENTERED, COLS*scale, ROWS*scale, SDL_WINDOW_RESIZABLE)
+		self._sdlrenderer = SDL_CreateRenderer(self._window, -1, SDL_RENDERER_ACCELERATED)
+		SDL_RenderSetLogicalSize(self._sdlrenderer, COLS, ROWS)
+		self._sdltexturebuffer = SDL_CreateTexture(self._sdlrenderer, SDL_PIXELFORMAT_ABGR8888, SDL_TEXTUREACCESS_STATIC, COLS, ROWS)
+		SDL_ShowWindow(self._window)
+
+	def handle_events(self, mb) -> bool:
+		# Returns True when the window is closed
+		event = SDL_Event()
+		while SDL_PollEvent(ctypes.byref(event)) != 0:
+			if event.type == SDL_QUIT:
+				return True
+			elif event.type == SDL_KEYDOWN or event.type == SDL_KEYUP:
+				button = KEYMAP.get(event.key.keysym.sym)
+				if button is not None and mb.joypad.key_event(button, event.type == SDL_KEYDOWN):
+					mb.cpu.set_interruptflag(INTR_HIGHTOLOW)
+			else:
+				pass
+		return False
+
+	def update_frame(self, screenbuffer_ptr):
+		# None keeps the picture on the screen, when the frame didn't change
+		if screenbuffer_ptr is not None:
+			SDL_UpdateTexture(self._sdltexturebuffer, None, screenbuffer_ptr, COLS * 4)
+			SDL_RenderCopy(self._sdlrenderer, self._sdltexturebuffer, None, None)
+			SDL_RenderPresent(self._sdlrenderer)
+			SDL_RenderClear(self._sdlrenderer)
+		self.frame_limiter(1)
+
+	def frame_limiter(self, speed):
+		self._ftime += int((1.0 / (60.0*speed)) * 1_000_000_000)
+		now = time.perf_counter_ns()
+		if (self._ftime > now):
+			delay = (self._ftime - now) // 1_000_000
+			SDL_Delay(delay)
+		else:
+			self._ftime = now
+		return True
+
+	def stop(self):
+		SDL_DestroyTexture(self._sdltexturebuffer)
+		SDL_DestroyRenderer(self._sdlrenderer)
+		SDL_DestroyWindow(self._window)
+		SDL_Quit()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*- 
+#!/usr/bin/env python
+import io
+from multiprocessing import Pipe, Process, shared_memory
+
+import numpy as np
+
+import gbcore as gb
+from gbcore.mobo import UNLIMITED
+from gbcore.observation import Observation
+from gbcore.parameters import ROWS, COLS, INTR_HIGHTOLOW
+
+# Buttons held for each action
+ACTIONS = (
+	(),
+	("a",),
+	("b",),
+	("left",),
+	("right",),
+	("up",),
+	("down",),
+	("start",),
+	("select",),
+	("right", "a"),
+	("right", "b"),
+	("left", "a"),
+	("left", "b"),
+)
+
+class _Environments:
+	# The instances run by one process, writing into their rows of the observation and RAM arrays
+	def __init__(self, rom, count, frame_skip, ram_addresses, actions, observation, observations, ram):
+		template = gb.Mobo(headless=True)
+		template.load(rom)
+		state = io.BytesIO()
+		template.save_state(state)
+		self.initial_state = state.getvalue()
+		self.machines = [template] + [template.clone() for _ in range(count - 1)]
+		if observation is not None:
+			# Built by the PPU from the last frame of each step
+			for mb in self.machines:
+				mb.ppu.set_observation(Observation(interval=frame_skip, **observation))
+		self.frame_skip = frame_skip
+		self.ram_addresses = ram_addresses
+		self.actions = actions
+		self.observations = observations
+		self.ram = ram
+		self.held = [()] * count
+		# The screen buffers are updated in place, so these views stay valid across steps and resets
+		if observation is not None:
+			self.screens = [mb.ppu.observation.frames for mb in self.machines]
+		else:
+			self.screens = [mb.ppu.get_screen() for mb in self.machines]
+
+	def reset(self):
+		for i, mb in enumerate(self.machines):
+			mb.load_state(io.BytesIO(self.initial_state))
+			if mb.ppu.observation is not None:
+				mb.ppu.observation.reset(mb.ppu)
+			self.held[i] = ()
+			self.observe(i)
+
+	def step(self, actions):
+		for i, mb in enumerate(self.machines):
+			buttons = self.actions[actions[i]]
+			held = self.held[i]
+			if buttons != held:
+				for button in held:
+					if button not in buttons:
+						mb.joypad.key_event(button, False)
+				for button in buttons:
+					if button not in held and mb.joypad.key_event(button, True):
+						mb.cpu.set_interruptflag(INTR_HIGHTOLOW)
+				self.held[i] = buttons
+			mb.run(UNLIMITED, self.frame_skip)
+			self.observe(i)
+
+	def observe(self, i):
+		mb = self.machines[i]
+		if mb.ppu.observation is None:
+			mb.ppu.update_screen() # The views in `screens` aren't converted in index mode
+		np.copyto(self.observations[i], self.screens[i])
+		ram = self.ram[i]
+		for n, address in enumerate(self.ram_addresses):
+			ram[n] = mb.getitem(address)
+
+def _worker(conn, shm_name, start, count, rom, frame_skip, ram_addresses, actions, observation, shape):
+	shm = shared_memory.SharedMemory(name=shm_name)
+	observations, ram = _shared_arrays(shm, shape, len(ram_addresses))
+	envs = _Environments(rom, count, frame_skip, ram_addresses, actions, observation, observations[start:start + count],
+		ram[start:start + count])
+	conn.send(None)
+	while True:
+		command, args = conn.recv()
+		if command == "step":
+			envs.step(args)
+		elif command == "reset":
+			envs.reset()
+		else:
+			break
+		conn.send(None)
+	del observations, ram, envs
+	shm.close()
+
+def _shared_arrays(shm, shape, ram_count):
+	observations = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+	ram = np.ndarray((shape[0], ram_count), dtype=np.uint8, buffer=shm.buf, offset=observations.nbytes)
+	return observations, ram
+
+# 多环境
+class VectorEnv:
+	"""Steps `num_envs` instances of one ROM in lockstep, for reinforcement learning.
+
+	`step` takes one action index (into `actions`) per instance, holds those buttons for `frame_skip` frames, and
+	returns the (num_envs, 144, 160, 4) RGBA observations together with the (num_envs, len(ram_addresses)) RAM bytes.
+	`observation` can be a dict of Observation arguments (size, crop, grayscale, stack), which makes the observations
+	(num_envs, stack, height, width) instead. Both arrays are preallocated and overwritten by every step, so copy them
+	if they need to be kept. With `processes` > 0, the instances are spread over that many worker processes, which
+	write into shared memory.
+	"""
+	def __init__(self, rom: str, num_envs: int, frame_skip: int = 4, ram_addresses=(), actions=ACTIONS,
+			observation: dict = None, processes: int = 0):
+		self.num_envs = num_envs
+		self.actions = actions
+		self.ram_addresses = tuple(ram_addresses)
+		self.workers = []
+		self.shm = None
+		if observation is not None:
+			frames = Observation(**observation).frames
+			shape = (num_envs,) + frames.shape
+		else:
+			shape = (num_envs, ROWS, COLS, 4)
+		if processes > 0:
+			size = int(np.prod(shape)) + num_envs * len(self.ram_addresses)
+			self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+			self.observations, self.ram = _shared_arrays(self.shm, shape, len(self.ram_addresses))
+			self.envs = None
+			processes = min(processes, num_envs)
+			for n in range(processes):
+				start = num_envs * n // processes
+				end = num_envs * (n + 1) // processes
+				conn, child = Pipe()
+				process = Process(target=_worker, args=(child, self.shm.name, start, end - start, rom, frame_skip,
+					self.ram_addresses, actions, observation, shape), daemon=True)
+				process.start()
+				self.workers.append((conn, process, start, end))
+			for conn, process, start, end in self.workers:
+				conn.recv() # Loaded
+		else:
+			self.observations = np.zeros(shape, dtype=np.uint8)
+			self.ram = np.zeros((num_envs, len(self.ram_addresses)), dtype=np.uint8)
+			self.envs = _Environments(rom, num_envs, frame_skip, self.ram_addresses, actions, observation,
+				self.observations, self.ram)
+
+	def reset(self):
+		if self.envs is not None:
+			self.envs.reset()
+		else:
+			self.__broadcast("reset", None)
+		return self.observations, self.ram
+
+	def step(self, actions):
+		if self.envs is not None:
+			self.envs.step(actions)
+		else:
+			self.__broadcast("step", actions)
+		return self.observations, self.ram
+
+	def __broadcast(self, command, actions):
+		# Every worker runs its share of the instances at the same time
+		for conn, process, start, end in self.workers:
+			conn.send((command, None if actions is None else [int(a) for a in actions[start:end]]))
+		for conn, process, start, end in self.workers:
+			conn.recv()
+
+	def close(self):
+		for conn, process, start, end in self.workers:
+			conn.send(("close", None))
+			process.join()
+		self.workers = []
+		if self.shm is not None:
+			del self.observations, self.ram
+			self.shm.close()
+			self.shm.unlink()
+			self.shm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()